@@ -0,0 +1,109 @@
+import os
+import fcntl
+import ctypes
+import threading
+import bustrace
+from .wirebus import I2C
+
+# ===========================================================================
+# Talks to /dev/i2c-N with the I2C_RDWR ioctl (linux/i2c-dev.h), which submits several
+# messages, even to different devices, in one kernel call and isn't limited to
+# 32 byte SMBus blocks.
+# ===========================================================================
+
+I2C_RDWR = 0x0707
+I2C_RDWR_IOCTL_MAX_MSGS = 42        # the kernel rejects larger transfers
+
+
+class i2c_msg(ctypes.Structure):
+    _fields_ = [
+        ('addr', ctypes.c_uint16),
+        ('flags', ctypes.c_uint16),
+        ('len', ctypes.c_uint16),
+        ('buf', ctypes.POINTER(ctypes.c_uint8)),
+    ]
+
+
+class i2c_rdwr_ioctl_data(ctypes.Structure):
+    _fields_ = [
+        ('msgs', ctypes.POINTER(i2c_msg)),
+        ('nmsgs', ctypes.c_uint32),
+    ]
+
+
+class Bus(object):
+    """Combined write transfers on /dev/i2c-N.
+
+    Uses the file descriptor and lock of the pooled wirebus.SharedBus, so the transfers are
+    serialized with all other transactions on the bus and hardware.close_buses() closes it.
+    fd and ioctl can be injected to run against a fake device instead of the kernel."""
+
+    def __init__(self, busnum, fd=None, ioctl=None, logger=None):
+        self.busnum = busnum
+        self.logger = logger
+        if fd is not None:
+            self._shared = None
+            self._fd = fd
+            self.lock = threading.RLock()
+        else:
+            self._shared = I2C.sharedBus(busnum)
+            self._fd = None
+            self.lock = self._shared.lock
+        self._ioctl = ioctl if ioctl is not None else fcntl.ioctl
+        self.transfers = 0
+
+    @property
+    def fd(self):
+        return self._fd if self._shared is None else self._shared.fileno()
+
+    def close(self):
+        "Closes an injected fd, the shared one is closed with the other pooled buses"
+        with self.lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    def transfer(self, writes):
+        "Writes all (address, register, data) messages, in as few ioctl calls as the kernel allows"
+        with self.lock:
+            for first in range(0, len(writes), I2C_RDWR_IOCTL_MAX_MSGS):
+                self._submit(writes[first:first+I2C_RDWR_IOCTL_MAX_MSGS])
+
+    def _submit(self, writes):
+        messages = (i2c_msg * len(writes))()
+        buffers = []            # keeps the message buffers alive until the ioctl returned
+        for message, (address, register, data) in zip(messages, writes):
+            buffer = (ctypes.c_uint8 * (len(data) + 1))(register, *data)
+            buffers.append(buffer)
+            message.addr = address
+            message.flags = 0
+            message.len = len(buffer)
+            message.buf = buffer
+        request = i2c_rdwr_ioctl_data(messages, len(writes))
+        trace = bustrace.buffer
+        try:
+            self._ioctl(self.fd, I2C_RDWR, request)
+        except IOError:
+            if trace is not None:
+                trace.error(self.busnum, writes[0][0], writes[0][1])
+            raise
+        self.transfers += 1
+        if trace is not None:
+            for address, register, data in writes:
+                trace.record(bustrace.WRITE_LIST, self.busnum, address, register, data)
+
+    def flushDrivers(self, drivers):
+        """Writes the changed LED registers of all pca9685.Driver instances in one transfer.
+        Raises IOError after marking all drivers for a full rewrite if the transfer failed."""
+        pending = [(driver, driver.pendingWrites()) for driver in drivers]
+        writes = [(driver.address, register, data) for driver, driver_writes in pending for register, data in driver_writes]
+        if not writes:
+            return
+        try:
+            self.transfer(writes)
+        except IOError:
+            for driver, _ in pending:
+                driver.markFailed()
+            raise
+        for driver, driver_writes in pending:
+            driver.markWritten(driver_writes)
@@ -8,6 +8,8 @@ from .wirebus import I2C
 # ===========================================================================
 
 class Driver(object):
+    _I2C = I2C                  # bus implementation, the dummy driver swaps in the emulated one
+
     # Registers/etc.
     __MODE1              = 0x00
     __MODE2              = 0x01
@@ -33,33 +35,44 @@ class Driver(object):
     __INVRT              = 1 << 4
     __OUTDRV             = 1 << 2
 
+    OSCILLATOR_DELAY     = 0.005            # seconds after leaving sleep mode
+
+    __LED_COUNT          = 16
+    __BLOCK_SIZE         = 32               # SMBus block write limit in bytes
+
 
     @classmethod
     def softwareReset(cls):
         "Sends a software reset (SWRST) command to all the servo drivers on the bus"
-        bus_numbers = I2C.pinoutConfiguredBuses()
+        bus_numbers = cls._I2C.pinoutConfiguredBuses()
         for bus_number in bus_numbers:
-            if I2C.isDeviceAnswering(0x00, bus_number):
-                general_call = I2C(0x00, bus_number)
+            if cls._I2C.isDeviceAnswering(0x00, bus_number):
+                general_call = cls._I2C(0x00, bus_number)
                 general_call.writeRaw8(0x06)            # SWRST
 
-    def __init__(self, address=0x40, busnum=-1, logger=None):
+    def __init__(self, address=0x40, busnum=-1, logger=None, waitForOscillator=True):
+        """Pass waitForOscillator=False when initializing several drivers and wait
+        OSCILLATOR_DELAY once after the last one"""
         self.logger = logger
-        self.i2c = I2C(address, busnum=busnum, logger=self.logger)
+        self.i2c = self._I2C(address, busnum=busnum, logger=self.logger)
         self.address = address
+        self._frame = bytearray(4 * self.__LED_COUNT)      # LEDn_ON_L..LEDn_OFF_H of all channels, as queued
+        self._shadow = bytearray(4 * self.__LED_COUNT)     # ... as last written to the device
+        self._shadow_valid = False
         if self.logger is not None:
             self.logger.debug("Reseting PCA9685 MODE1 (without SLEEP, but with AI) and MODE2")
         self.setAllPWM(0, 0)
         self.i2c.write8(self.__MODE2, self.__OUTDRV)
         self.i2c.write8(self.__MODE1, self.__ALLCALL | self.__AI)
-        time.sleep(0.005)                                       # wait for oscillator
+        if waitForOscillator:
+            time.sleep(self.OSCILLATOR_DELAY)
 
     def wakeUp(self):
         "Activates the sleep mode"
         mode1 = self.i2c.readU8(self.__MODE1)
         mode1 = mode1 & ~self.__SLEEP
         self.i2c.write8(self.__MODE1, mode1)
-        time.sleep(0.005)
+        time.sleep(self.OSCILLATOR_DELAY)
 
     def sleep(self):
         "Deactivates the sleep mode"
@@ -87,21 +100,89 @@ class Driver(object):
         self.i2c.write8(self.__PRESCALE, prescale)
         self.i2c.write8(self.__MODE1, oldmode)
         # restart (datasheet section 7.3.1.1)
-        time.sleep(0.005)                                         # wait for oscillator
+        time.sleep(self.OSCILLATOR_DELAY)                         # wait for oscillator
         self.i2c.write8(self.__MODE1, oldmode | self.__RESTART)
 
     def _scale_value(self, value):
         if value < 0 or value > 1: raise ValueError('PWM value not in interval [0, 1]: %s' % value)
         return int(value * 4095)
 
+    def _registers(self, on, off):
+        return [on & 0xFF, on >> 8, off & 0xFF, off >> 8]
+
     def setPWM(self, channel, on, off):
         "Sets a single PWM channel"
-        on = self._scale_value(on)
-        off = self._scale_value(off)
-        self.i2c.writeList(self.__LED0_ON_L+4*channel, [on & 0xFF, on >> 8, off & 0xFF, off >> 8])
+        registers = self._registers(self._scale_value(on), self._scale_value(off))
+        self._frame[4*channel:4*channel+4] = bytes(registers)
+        if self.i2c.writeList(self.__LED0_ON_L+4*channel, registers) != -1:
+            self._shadow[4*channel:4*channel+4] = bytes(registers)
 
     def setAllPWM(self, on, off):
         "Sets a all PWM channels"
-        on = self._scale_value(on)
-        off = self._scale_value(off)
-        self.i2c.writeList(self.__ALL_LED_ON_L, [on & 0xFF, on >> 8, off & 0xFF, off >> 8])
+        registers = self._registers(self._scale_value(on), self._scale_value(off))
+        self._frame[:] = bytes(registers) * self.__LED_COUNT
+        if self.i2c.writeList(self.__ALL_LED_ON_L, registers) != -1:
+            self._shadow[:] = self._frame
+            self._shadow_valid = True
+
+    def queuePWM(self, channel, on, off):
+        "Queues a single PWM channel to be written by the next flush()"
+        self.queuePWMCounts(channel, self._scale_value(on), self._scale_value(off))
+
+    def queuePWMCounts(self, channel, on, off):
+        "Queues a single PWM channel given as raw 12-bit counts [0, 4095]"
+        offset = 4 * channel
+        frame = self._frame
+        frame[offset] = on & 0xFF
+        frame[offset + 1] = on >> 8
+        frame[offset + 2] = off & 0xFF
+        frame[offset + 3] = off >> 8
+
+    def pendingWrites(self, blockSize=None):
+        """Returns (register, bytes) writes covering all LED channels that differ from the
+        shadow copy, each at most blockSize bytes long (None for one write from the first to
+        the last changed channel). Writes always cover whole channels, so the ON and OFF
+        halves of a channel never go out in separate transactions and show a glitch."""
+        frame = self._frame
+        if self._shadow_valid:
+            if frame == self._shadow: return []
+            shadow = self._shadow
+            changed = [channel for channel in range(self.__LED_COUNT) if frame[4*channel:4*channel+4] != shadow[4*channel:4*channel+4]]
+        else:
+            changed = list(range(self.__LED_COUNT))
+        channelsPerBlock = self.__LED_COUNT if blockSize is None else blockSize // 4
+
+        writes = []
+        index = 0
+        while index < len(changed):
+            first = changed[index]
+            while index < len(changed) and changed[index] < first + channelsPerBlock:
+                index += 1
+            end = changed[index - 1] + 1
+            writes.append((self.__LED0_ON_L+4*first, bytes(frame[4*first:4*end])))
+        return writes
+
+    def markWritten(self, writes):
+        "Updates the shadow copy after pendingWrites() went to the device by other means"
+        for register, data in writes:
+            first = register - self.__LED0_ON_L
+            self._shadow[first:first+len(data)] = data
+        self._shadow_valid = True
+
+    def markFailed(self):
+        "The device is in an unknown state, the next write covers all LED registers"
+        self._shadow_valid = False
+
+    def flush(self):
+        "Writes all LED registers that differ from the shadow copy using as few block writes as possible"
+        writes = self.pendingWrites(self.__BLOCK_SIZE)
+        for register, data in writes:
+            if self.i2c.writeList(register, list(data)) == -1:
+                self.markFailed()
+                return
+        self.markWritten(writes)
+
+    def resync(self):
+        "Rewrites all LED registers, e.g. after a bus error left the device in an unknown state"
+        self._shadow_valid = False
+        self.flush()
@@ -3,13 +3,75 @@
 import os
 import mmap
 import time
-import smbus
+import metrics
+import bustrace
+import threading
 
 # ===========================================================================
 # Based on https://github.com/adafruit/Adafruit-Raspberry-Pi-Python-Code
 # Copyright (c) 2012-2013 Limor Fried, Kevin Townsend and Mikey Sklar for Adafruit Industries. All rights reserved.
 # ===========================================================================
 
+_write8_timer = metrics.histogram('shelftris_i2c_write8_seconds', 'Duration of an I2C write8')
+_write_list_timer = metrics.histogram('shelftris_i2c_write_list_seconds', 'Duration of an I2C writeList')
+
+class SharedBus(object):
+    "One SMBus handle per /dev/i2c-N shared by all devices on it. Transactions are serialized by a lock."
+
+    def __init__(self, busnum):
+        self.busnum = busnum
+        self.lock = threading.RLock()
+        import smbus            # only needed once a bus is opened, so the driver logic runs off-Pi against dummy.wirebus
+        self._bus = smbus.SMBus(busnum)
+        self._fd = None
+
+    def close(self):
+        with self.lock:
+            self._bus.close()
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    def fileno(self):
+        "Raw /dev/i2c-N file descriptor for ioctls SMBus doesn't offer, like I2C_RDWR. Hold the lock while using it."
+        with self.lock:
+            if self._fd is None:
+                self._fd = os.open('/dev/i2c-%d' % self.busnum, os.O_RDWR)
+            return self._fd
+
+    def write_quick(self, address):
+        with self.lock:
+            return self._bus.write_quick(address)
+
+    def write_byte(self, address, value):
+        with self.lock:
+            return self._bus.write_byte(address, value)
+
+    def write_byte_data(self, address, reg, value):
+        with self.lock:
+            return self._bus.write_byte_data(address, reg, value)
+
+    def write_word_data(self, address, reg, value):
+        with self.lock:
+            return self._bus.write_word_data(address, reg, value)
+
+    def write_i2c_block_data(self, address, reg, data):
+        with self.lock:
+            return self._bus.write_i2c_block_data(address, reg, data)
+
+    def read_byte_data(self, address, reg):
+        with self.lock:
+            return self._bus.read_byte_data(address, reg)
+
+    def read_word_data(self, address, reg):
+        with self.lock:
+            return self._bus.read_word_data(address, reg)
+
+    def read_i2c_block_data(self, address, reg, length):
+        with self.lock:
+            return self._bus.read_i2c_block_data(address, reg, length)
+
+
 class I2C(object):
     __BLOCK_SIZE = 4096
     __BCM2708_PERI_BASE = 0x20000000 # Base address of peripheral registers
@@ -21,10 +83,19 @@ class I2C(object):
     __GPIO_PUD_OFF = 0b00   # Off - disable pull-up/down
     __GPIO_PUD_UP = 0b10    # Enable Pull Up control
 
+    _revision = None
+    _buses = {}             # bus number -> SharedBus
+    _buses_lock = threading.Lock()
+
+    @classmethod
+    def _piRevision(cls):
+        "Gets the version number of the Raspberry Pi board, read once"
+        if cls._revision is None:
+            cls._revision = cls._readPiRevision()
+        return cls._revision
 
     @staticmethod
-    def _piRevision():
-        "Gets the version number of the Raspberry Pi board"
+    def _readPiRevision():
         # Courtesy quick2wire-python-api
         # https://github.com/quick2wire/quick2wire-python-api
         try:
@@ -33,7 +104,8 @@ class I2C(object):
                     if line.startswith('Revision'):
                         return 1 if line.rstrip()[-1] in ['1','2'] else 2
         except:
-            return 0
+            pass
+        return 0
 
     @classmethod
     def defaultBusNumber(cls):
@@ -150,15 +222,44 @@ class I2C(object):
         # No longer need the mmap
         memory.close()
 
+    @classmethod
+    def sharedBus(cls, busnum=-1):
+        "Returns the pooled SharedBus for the bus number, opened on first use"
+        busnum = busnum if busnum >= 0 else cls.defaultBusNumber()
+        with cls._buses_lock:
+            if busnum not in cls._buses:
+                cls._buses[busnum] = SharedBus(busnum)
+            return cls._buses[busnum]
+
+    @classmethod
+    def closeAllBuses(cls):
+        "Closes all pooled bus handles, e.g. at shutdown. Later instances open them again."
+        with cls._buses_lock:
+            buses = list(cls._buses.values())
+            cls._buses.clear()
+        for bus in buses:
+            bus.close()
+
     @classmethod
     def isDeviceAnswering(cls, address, busnum=-1):
         "Checks if a device is answering on the given address"
+        return address in cls.answeringDevices([address], busnum)
+
+    @classmethod
+    def answeringDevices(cls, addresses, busnum=-1):
+        "Probes all addresses in one scan on the shared bus handle, returns the set of answering ones"
         try:
-            bus = smbus.SMBus(busnum if busnum >= 0 else cls.defaultBusNumber())
-            bus.write_quick(address)
-            return True
+            bus = cls.sharedBus(busnum)
         except IOError as err:
-            return False
+            return set()
+        answering = set()
+        for address in addresses:
+            try:
+                bus.write_quick(address)
+                answering.add(address)
+            except IOError as err:
+                pass
+        return answering
 
     def __init__(self, address, busnum=-1, logger=None):
         self.logger = logger
@@ -167,7 +268,7 @@ class I2C(object):
         # Alternatively, you can hard-code the bus version below:
         # self.bus = smbus.SMBus(0); # Force I2C0 (early 256MB Pi's)
         # self.bus = smbus.SMBus(1); # Force I2C1 (512MB Pi's)
-        self.bus = smbus.SMBus(busnum if busnum >= 0 else I2C.defaultBusNumber())
+        self.bus = I2C.sharedBus(busnum)
 
     def reverseByteOrder(self, data):
         "Reverses the byte order of an int (16-bit) or long (32-bit) value"
@@ -180,25 +281,32 @@ class I2C(object):
         return val
 
     def errMsg(self):
+        if bustrace.buffer is not None:
+            bustrace.buffer.error(self.bus.busnum, self.address)
         if self.logger is not None:
             self.logger.error("Error accessing 0x%02X: Check your I2C address", self.address)
         return -1
 
     def write8(self, reg, value):
         "Writes an 8-bit value to the specified register/address"
+        start = time.perf_counter()
         try:
             self.bus.write_byte_data(self.address, reg, value)
-            if self.logger is not None:
-                self.logger.debug("I2C: Wrote 0x%02X to register 0x%02X", value, reg)
+            trace = bustrace.buffer
+            if trace is not None:
+                trace.record(bustrace.WRITE8, self.bus.busnum, self.address, reg, (value,))
         except IOError as err:
             return self.errMsg()
+        finally:
+            _write8_timer.observe(time.perf_counter() - start)
 
     def write16(self, reg, value):
         "Writes a 16-bit value to the specified register/address pair"
         try:
             self.bus.write_word_data(self.address, reg, value)
-            if self.logger is not None:
-                self.logger.debug("I2C: Wrote 0x%02X to register pair 0x%02X,0x%02X", value, reg, reg+1)
+            trace = bustrace.buffer
+            if trace is not None:
+                trace.record(bustrace.WRITE16, self.bus.busnum, self.address, reg, (value & 0xFF, value >> 8))
         except IOError as err:
             return self.errMsg()
 
@@ -206,26 +314,32 @@ class I2C(object):
         "Writes an 8-bit value on the bus"
         try:
             self.bus.write_byte(self.address, value)
-            if self.logger is not None:
-                self.logger.debug("I2C: Wrote 0x%02X", value)
+            trace = bustrace.buffer
+            if trace is not None:
+                trace.record(bustrace.WRITE_RAW8, self.bus.busnum, self.address, 0, (value,))
         except IOError as err:
             return self.errMsg()
 
     def writeList(self, reg, list):
         "Writes an array of bytes using I2C format"
+        start = time.perf_counter()
         try:
-            if self.logger is not None:
-                self.logger.debug("I2C: Writing list to register 0x%02X:\n%s", reg, list)
             self.bus.write_i2c_block_data(self.address, reg, list)
+            trace = bustrace.buffer
+            if trace is not None:
+                trace.record(bustrace.WRITE_LIST, self.bus.busnum, self.address, reg, list)
         except IOError as err:
             return self.errMsg()
+        finally:
+            _write_list_timer.observe(time.perf_counter() - start)
 
     def readList(self, reg, length):
         "Read a list of bytes from the I2C device"
         try:
             results = self.bus.read_i2c_block_data(self.address, reg, length)
-            if self.logger is not None:
-                self.logger.debug("I2C: Device 0x%02X returned the following from reg 0x%02X:\n%s", self.address, reg, results)
+            trace = bustrace.buffer
+            if trace is not None:
+                trace.record(bustrace.READ_LIST, self.bus.busnum, self.address, reg, results)
             return results
         except IOError as err:
             return self.errMsg()
@@ -234,8 +348,9 @@ class I2C(object):
         "Read an unsigned byte from the I2C device"
         try:
             result = self.bus.read_byte_data(self.address, reg)
-            if self.logger is not None:
-                self.logger.debug("I2C: Device 0x%02X returned 0x%02X from reg 0x%02X", self.address, result & 0xFF, reg)
+            trace = bustrace.buffer
+            if trace is not None:
+                trace.record(bustrace.READ8, self.bus.busnum, self.address, reg, (result & 0xFF,))
             return result
         except IOError as err:
             return self.errMsg()
@@ -245,8 +360,9 @@ class I2C(object):
         try:
             result = self.bus.read_byte_data(self.address, reg)
             if result > 127: result -= 256
-            if self.logger is not None:
-                self.logger.debug("I2C: Device 0x%02X returned 0x%02X from reg 0x%02X", self.address, result & 0xFF, reg)
+            trace = bustrace.buffer
+            if trace is not None:
+                trace.record(bustrace.READ8, self.bus.busnum, self.address, reg, (result & 0xFF,))
             return result
         except IOError as err:
             return self.errMsg()
@@ -255,8 +371,9 @@ class I2C(object):
         "Reads an unsigned 16-bit value from the I2C device"
         try:
             result = self.bus.read_word_data(self.address,reg)
-            if self.logger is not None:
-                self.logger.debug("I2C: Device 0x%02X returned 0x%04X from reg 0x%02X", self.address, result & 0xFFFF, reg)
+            trace = bustrace.buffer
+            if trace is not None:
+                trace.record(bustrace.READ16, self.bus.busnum, self.address, reg, (result & 0xFF, (result >> 8) & 0xFF))
             return result
         except IOError as err:
             return self.errMsg()
@@ -265,8 +382,9 @@ class I2C(object):
         "Reads a signed 16-bit value from the I2C device"
         try:
             result = self.bus.read_word_data(self.address,reg)
-            if self.logger is not None:
-                self.logger.debug("I2C: Device 0x%02X returned 0x%04X from reg 0x%02X", self.address, result & 0xFFFF, reg)
+            trace = bustrace.buffer
+            if trace is not None:
+                trace.record(bustrace.READ16, self.bus.busnum, self.address, reg, (result & 0xFF, (result >> 8) & 0xFF))
             return result
         except IOError as err:
             return self.errMsg()
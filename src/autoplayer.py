@@ -0,0 +1,219 @@
+#!/usr/bin/env python3.4
+
+"""Plays Tetris on its own, either on a Game (demo mode) or headless to tune the heuristics.
+
+Boards are handled as lists of column bitboards like Field.columns, so evaluating a
+placement never touches any colors. The search over the first piece's placements can be
+spread across a concurrent.futures executor (e.g. a ProcessPoolExecutor).
+"""
+
+import sys
+import json
+import time
+import random
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from shelftris import Brick, Color, Shape, column_height, drop_distance
+
+# Heuristic weights after Yiyuan Lee's "Tetris AI - The (Near) Perfect Bot"
+DEFAULT_WEIGHTS = OrderedDict([
+    ('aggregate_height', -0.510066),
+    ('lines', 0.760666),
+    ('holes', -0.35663),
+    ('bumpiness', -0.184483),
+])
+
+SHAPES = list(Shape)
+
+def _unique_rotations(shape):
+    rotations = []
+    for rotation, masks in enumerate(Brick.rotation_masks(shape)):
+        if masks not in [other for _, other in rotations]:
+            rotations.append((rotation, masks))
+    return rotations
+
+_UNIQUE_ROTATIONS = {shape: _unique_rotations(shape) for shape in Shape}
+
+
+def collides(columns, masks, x, y):
+    for offset, mask in enumerate(masks):
+        if columns[x + offset] & (mask << y):
+            return True
+    return False
+
+def place(columns, width, height, masks, x, y):
+    "Returns the new columns and the number of cleared lines"
+    columns = list(columns)
+    for offset, mask in enumerate(masks):
+        columns[x + offset] |= mask << y
+
+    lines = 0
+    brick_height = max(mask.bit_length() for mask in masks)
+    for row in range(y, y + brick_height):
+        bit = 1 << row
+        if all(column & bit for column in columns):
+            above = bit - 1
+            below = ~((bit << 1) - 1)
+            columns = [((column & above) << 1) | (column & below) for column in columns]
+            lines += 1
+    return columns, lines
+
+def placements(columns, width, height, shape):
+    "Yields (rotation, x, new columns, cleared lines) for every way the shape can be dropped from the top"
+    for rotation, masks in _UNIQUE_ROTATIONS[shape]:
+        for x in range(width - len(masks) + 1):
+            if max(mask.bit_length() for mask in masks) > height or collides(columns, masks, x, 0):
+                continue
+            y = drop_distance(columns, height, masks, x, 0)
+            new_columns, lines = place(columns, width, height, masks, x, y)
+            yield rotation, x, new_columns, lines
+
+def evaluate(columns, height, lines, weights):
+    heights = [column_height(column, height) for column in columns]
+    holes = sum(column_height(column, height) - bin(column).count('1') for column in columns)
+    bumpiness = sum(abs(a - b) for a, b in zip(heights, heights[1:]))
+    return (weights['aggregate_height'] * sum(heights) +
+            weights['lines'] * lines +
+            weights['holes'] * holes +
+            weights['bumpiness'] * bumpiness)
+
+def search(columns, width, height, shapes, weights, lines=0):
+    "Best score reachable by placing all given shapes in order, None if they don't fit"
+    if not shapes:
+        return evaluate(columns, height, lines, weights)
+    best = None
+    for _, _, new_columns, new_lines in placements(columns, width, height, shapes[0]):
+        score = search(new_columns, width, height, shapes[1:], weights, lines + new_lines)
+        if score is not None and (best is None or score > best):
+            best = score
+    return best
+
+def _search_task(arguments):
+    return search(*arguments)
+
+def best_placement(columns, width, height, shapes, weights, executor=None):
+    "Returns (rotation, x) for shapes[0] considering the following shapes, None if it doesn't fit"
+    candidates = list(placements(columns, width, height, shapes[0]))
+    tasks = [(new_columns, width, height, shapes[1:], weights, lines) for _, _, new_columns, lines in candidates]
+    if executor is None:
+        scores = map(_search_task, tasks)
+    else:
+        scores = executor.map(_search_task, tasks)
+    best = None
+    for (rotation, x, _, _), score in zip(candidates, scores):
+        if score is not None and (best is None or score > best[0]):
+            best = (score, rotation, x)
+    return None if best is None else best[1:]
+
+
+class AutoPlayer:
+    """Drives a Game by dropping the next piece whenever the previous one landed.
+
+    step() never blocks on the search when an executor is given: the candidates are
+    submitted and their results are picked up by a later step()."""
+
+    def __init__(self, game, lookahead=1, weights=None, executor=None, rng=None):
+        self.game = game
+        self.lookahead = lookahead
+        self.weights = weights if weights is not None else DEFAULT_WEIGHTS
+        self.executor = executor
+        self.rng = rng if rng is not None else random.Random()
+        self.games_played = 0
+        self._upcoming = [self.rng.choice(SHAPES) for _ in range(lookahead)]
+        self._search = None     # (shape, candidates, futures)
+
+    def step(self):
+        if self.game.bricks:
+            return
+        if self._search is None:
+            self._start_search()
+        if self._search is not None and all(future.done() for future in self._search[2]):
+            self._finish_search()
+
+    def _start_search(self):
+        field = self.game.field
+        shapes = self._upcoming
+        if self.executor is None:
+            self._drop(shapes[0], best_placement(field.columns, field.width, field.height, shapes, self.weights))
+            return
+        candidates = list(placements(field.columns, field.width, field.height, shapes[0]))
+        futures = [self.executor.submit(search, new_columns, field.width, field.height, shapes[1:], self.weights, lines)
+                   for _, _, new_columns, lines in candidates]
+        self._search = (shapes[0], candidates, futures)
+
+    def _finish_search(self):
+        shape, candidates, futures = self._search
+        self._search = None
+        best = None
+        for (rotation, x, _, _), future in zip(candidates, futures):
+            score = future.result()
+            if score is not None and (best is None or score > best[0]):
+                best = (score, rotation, x)
+        self._drop(shape, None if best is None else best[1:])
+
+    def _drop(self, shape, placement):
+        self._upcoming = self._upcoming[1:] + [self.rng.choice(SHAPES)]
+        if placement is None:
+            self.game.field.clear()         # game over, start over
+            self.game.bricks = []
+            self.games_played += 1
+            return
+        rotation, x = placement
+        brick = Brick(shape, Color(SHAPES.index(shape) / len(SHAPES), 1, 1), x, 0)
+        for _ in range(rotation):
+            brick.rotate_cw()
+        self.game.place_brick(brick)
+
+
+def play(width, height, weights, lookahead=1, max_pieces=1000, seed=None):
+    "Plays one headless game, returns (pieces, lines)"
+    rng = random.Random(seed)
+    columns = [0] * width
+    upcoming = [rng.choice(SHAPES) for _ in range(lookahead)]
+    pieces = lines = 0
+    while pieces < max_pieces:
+        placement = best_placement(columns, width, height, upcoming, weights)
+        if placement is None:
+            break
+        rotation, x = placement
+        masks = Brick.rotation_masks(upcoming[0])[rotation]
+        columns, cleared = place(columns, width, height, masks, x, drop_distance(columns, height, masks, x, 0))
+        pieces += 1
+        lines += cleared
+        upcoming = upcoming[1:] + [rng.choice(SHAPES)]
+    return pieces, lines
+
+def _play_task(arguments):
+    return play(*arguments)
+
+def main():
+    parser = argparse.ArgumentParser(description="Plays headless games to tune the autoplayer heuristics")
+    parser.add_argument('--width', type=int, default=2)
+    parser.add_argument('--height', type=int, default=4)
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument('--lookahead', type=int, default=1)
+    parser.add_argument('--max-pieces', type=int, default=1000)
+    parser.add_argument('--processes', type=int, default=None, help="spread the games across a process pool")
+    parser.add_argument('--weights', type=json.loads, default=DEFAULT_WEIGHTS, help="JSON object of heuristic weights")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    tasks = [(args.width, args.height, args.weights, args.lookahead, args.max_pieces, args.seed + game)
+             for game in range(args.games)]
+    start = time.perf_counter()
+    if args.processes is None:
+        results = list(map(_play_task, tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=args.processes) as executor:
+            results = list(executor.map(_play_task, tasks, chunksize=max(1, args.games // (4 * args.processes))))
+    duration = time.perf_counter() - start
+
+    pieces = sum(result[0] for result in results)
+    lines = sum(result[1] for result in results)
+    print("%d games in %.2f s (%.0f games/s)" % (args.games, duration, args.games / duration))
+    print("avg pieces: %.1f  avg lines: %.1f" % (pieces / args.games, lines / args.games))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3.4
+
+"""Benchmarks the game, blend and output hot paths for a range of grid sizes.
+
+Runs headless against the emulated PCA9685s of the dummy backend, which also count the
+bus transactions and bytes per output frame. Results are printed and
+can be saved as JSON (--output) and compared against an earlier run (--compare).
+"""
+
+import os
+os.environ['SHELFTRIS_HARDWARE'] = 'dummy'
+
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+import tracemalloc
+from collections import OrderedDict
+
+from shelftris import *
+from hardware import IKEAShelf, wirebus
+from dummy.emulator import PCA9685
+
+SIZES = [(2, 4), (8, 16), (16, 32), (32, 64), (64, 128)]
+CHANNELS_PER_DRIVER = 16
+
+
+def random_color(rng):
+    return Color(rng.random(), rng.random(), rng.random())
+
+def filled_game(width, height, rng):
+    "Game with the lower half of the field randomly filled and a few falling bricks"
+    game = Game(width, height)
+    for x in range(width):
+        for y in range(height // 2, height):
+            if rng.random() < 0.7:
+                game.field.set_cell(x, y, random_color(rng))
+    for _ in range(max(1, width // 4)):
+        shape = rng.choice(list(Shape))
+        brick = Brick(shape, random_color(rng), rng.randrange(max(1, width - 3)), 0)
+        game.bricks.append(brick)
+    return game
+
+def shelf_config(width, height):
+    """Generated IKEA.json style config with one compartment per cell. Drivers fill the
+    valid PCA9685 addresses of one bus after the other, starting at the default bus."""
+    config = []
+    compartments_per_driver = CHANNELS_PER_DRIVER // 3
+    for index in range(width * height):
+        driver, slot = divmod(index, compartments_per_driver)
+        bus, address = divmod(driver, len(PCA9685.ADDRESSES))
+        config.append({
+            "position": [index // height, index % height],
+            "bus": wirebus.I2C.defaultBusNumber() + bus,
+            "driver_address": "0x%02X" % PCA9685.ADDRESSES[address],
+            "red": 3 * slot,
+            "green": 3 * slot + 1,
+            "blue": 3 * slot + 2,
+        })
+    return config
+
+
+class View:
+    "Minimal stand-in for ColorBlendingView handing out a fixed frame"
+    def __init__(self, frame):
+        self.frame = frame
+        self.width = frame.width
+        self.height = frame.height
+
+    def state(self):
+        return self.frame
+
+
+def benchmarks(width, height, rng):
+    "Yields (name, callable, cleanup, details) where details() returns extra results or is None"
+    game = filled_game(width, height, rng)
+    brick = Brick(Shape.T, random_color(rng), width // 2 - 1, 0)
+    position = (brick.x, brick.y + 1)
+    yield ('Field.can_move', lambda: game.field.can_move(brick, position), None, None)
+
+    field = game.field.copy()
+    yield ('Field.merge', lambda: field.merge(brick), None, None)
+
+    yield ('Game.state', game.state, None, None)
+
+    view = ColorBlendingView(game)
+    other_game = filled_game(width, height, rng)
+    targets = [game.state(), other_game.state()]
+    def blend():
+        targets.reverse()
+        view.blender.advance(targets[0], 0.025)
+    yield ('ColorBlendingView.blend', blend, None, None)
+
+    frames = [view.state()]
+    view.blender.advance(targets[1], 0.5)
+    frames.append(view.state())
+    wirebus.I2C.closeAllBuses()
+    config = shelf_config(width, height)
+    shelf = IKEAShelf(View(frames[0]), config=config)
+    buses = [wirebus.I2C.sharedBus(busnum) for busnum in sorted(set(square["bus"] for square in config))]
+    def output():
+        frames.reverse()
+        shelf._write_frame(frames[0])
+        for bus in buses:
+            bus.endFrame()
+    def bus_details():
+        "Totals over all buses, which the writer thread serves one after the other"
+        transactions, count, seconds = (sum(values) for values in zip(*(bus.lastFrame for bus in buses)))
+        return OrderedDict([('buses', len(buses)), ('bus_transactions', transactions), ('bus_bytes', count), ('bus_seconds', seconds)])
+    yield ('IKEAShelf.output', output, shelf.close, bus_details)
+
+    state = game.state()
+    yield ('stringify', lambda: stringify(state, vertical_border='|', horizontal_border='-'), None, None)
+
+
+def measure(function, min_time, min_iterations):
+    function()          # warm up
+
+    tracemalloc.start()
+    function()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    durations = []
+    started = time.perf_counter()
+    while len(durations) < min_iterations or time.perf_counter() - started < min_time:
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+
+    durations.sort()
+    return OrderedDict([
+        ('iterations', len(durations)),
+        ('mean', sum(durations) / len(durations)),
+        ('median', durations[len(durations) // 2]),
+        ('min', durations[0]),
+        ('peak_bytes', peak),
+        ('retained_bytes', retained),
+    ])
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_size(text):
+    width, height = text.lower().split('x')
+    return (int(width), int(height))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=lambda text: [parse_size(size) for size in text.split(',')],
+                        default=SIZES, help="comma separated WIDTHxHEIGHT list, default: %(default)s")
+    parser.add_argument('--min-time', type=float, default=0.2, help="seconds to spend per benchmark")
+    parser.add_argument('--min-iterations', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="save results as JSON to this file")
+    parser.add_argument('--compare', help="JSON file of an earlier run to compare against")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+
+    results = OrderedDict()
+    for width, height in args.sizes:
+        size = '%dx%d' % (width, height)
+        results[size] = OrderedDict()
+        for name, function, cleanup, details in benchmarks(width, height, random.Random(args.seed)):
+            result = measure(function, args.min_time, args.min_iterations)
+            if details is not None:
+                result.update(details())
+            if cleanup is not None:
+                cleanup()
+            results[size][name] = result
+
+            line = '%-9s %-25s %12.1f µs  %10d B peak' % (size, name, result['median'] * 1e6, result['peak_bytes'])
+            previous = baseline.get(size, {}).get(name) if baseline is not None else None
+            if previous is not None:
+                line += '  %+7.1f%%' % ((result['median'] / previous['median'] - 1) * 100)
+            if 'bus_transactions' in result:
+                line += '  %d transactions, %d B, %.1f ms on %d bus%s per frame' % (
+                    result['bus_transactions'], result['bus_bytes'], result['bus_seconds'] * 1e3,
+                    result['buses'], 'es' if result['buses'] > 1 else '')
+            print(line)
+            sys.stdout.flush()
+
+    if args.output is not None:
+        report = OrderedDict([
+            ('meta', OrderedDict([
+                ('revision', revision()),
+                ('python', platform.python_version()),
+                ('machine', platform.machine()),
+                ('timestamp', time.time()),
+            ])),
+            ('results', results),
+        ])
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
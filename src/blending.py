@@ -0,0 +1,177 @@
+from array import array
+
+# Easing curves map the linear blend progress [0, 1] onto [0, 1].
+# They have to be monotonic with f(0) == 0 and f(1) == 1.
+
+def linear(t):
+    return t
+
+def ease_in(t):
+    return t * t
+
+def ease_out(t):
+    return 1 - (1 - t) * (1 - t)
+
+def ease_in_out(t):
+    return t * t * (3 - 2 * t)
+
+
+class Blender:
+    """Blends the cells of a FrameBuffer towards a target frame.
+
+    Only cells that are still on their way to the target are visited. Target changes are
+    found by comparing the planes as bytes, first whole and then per column, so only the
+    columns that changed are scanned cell by cell. The easing curve is evaluated once per
+    distinct blend progress, not per cell, as cells started together share their progress."""
+
+    def __init__(self, current, easing=linear):
+        self.current = current
+        self.easing = easing
+        size = current.width * current.height
+        self.progress = array('f', [0.0]) * size
+        self._target_hue = array('f', [0.0]) * size
+        self._target_saturation = array('f', [0.0]) * size
+        self._target_brightness = array('f', [0.0]) * size
+        self._target_occupied = bytearray(size)
+        self._moving = set(range(size))       # indices of cells that may differ from their target
+
+    def advance(self, target, progress_step):
+        """Moves every cell of the current frame `progress_step` further towards `target`.
+
+        A changed target restarts the blend of that cell. Empty cells fade from and to
+        brightness 0 and hue always takes the shortest way around the color wheel."""
+        self._restart_changed(target)
+        moving = self._moving
+        if not moving:
+            return
+
+        ease = self.easing
+        progress = self.progress
+        steps = {}              # progress -> (new progress, blend factor or None to snap to the target)
+
+        hue = self.current.hue
+        saturation = self.current.saturation
+        brightness = self.current.brightness
+        occupied = self.current.occupied
+
+        target_hue = target.hue
+        target_saturation = target.saturation
+        target_brightness = target.brightness
+        target_occupied = target.occupied
+
+        settled = []
+        for i in moving:
+            t_occupied = target_occupied[i]
+            c_occupied = occupied[i]
+            if not c_occupied and not t_occupied:
+                settled.append(i)
+                continue
+
+            t_hue = target_hue[i]
+            t_saturation = target_saturation[i]
+            t_brightness = target_brightness[i]
+            c_hue = hue[i]
+            c_saturation = saturation[i]
+            c_brightness = brightness[i]
+
+            if c_occupied and t_occupied and c_hue == t_hue and c_saturation == t_saturation and c_brightness == t_brightness:
+                settled.append(i)
+                continue
+
+            if not t_occupied:
+                t_hue = c_hue
+                t_saturation = c_saturation
+                t_brightness = 0.0
+
+            if not c_occupied:
+                c_hue = t_hue
+                c_saturation = t_saturation
+                c_brightness = 0.0
+
+            current_progress = progress[i]
+            step = steps.get(current_progress)
+            if step is None:
+                new_progress = min(current_progress + progress_step, 1.0)
+                eased_progress = ease(current_progress)
+                if 1.0 - eased_progress < 0.0001 or new_progress >= 1.0:
+                    step = (new_progress, None)
+                else:
+                    step = (new_progress, (ease(new_progress) - eased_progress) / (1.0 - eased_progress))
+                steps[current_progress] = step
+            new_progress, factor = step
+
+            if factor is None:
+                c_hue = t_hue
+                c_saturation = t_saturation
+                c_brightness = t_brightness
+                settled.append(i)
+            else:
+                hue_difference = t_hue - c_hue
+                if hue_difference > 0.5:
+                    hue_difference -= 1
+                elif hue_difference < -0.5:
+                    hue_difference += 1
+                c_hue += hue_difference * factor
+                if c_hue > 1:
+                    c_hue -= 1
+                elif c_hue < 0:
+                    c_hue += 1
+
+                c_saturation += (t_saturation - c_saturation) * factor
+                c_brightness += (t_brightness - c_brightness) * factor
+
+            progress[i] = new_progress
+            if not t_occupied and new_progress >= 1.0:
+                occupied[i] = 0
+                hue[i] = saturation[i] = brightness[i] = 0.0
+            else:
+                occupied[i] = 1
+                hue[i] = c_hue
+                saturation[i] = c_saturation
+                brightness[i] = c_brightness
+
+        moving.difference_update(settled)
+
+    def _restart_changed(self, target):
+        "Restarts the blend of cells whose target changed since the last tick"
+        target_hue = target.hue
+        target_saturation = target.saturation
+        target_brightness = target.brightness
+        target_occupied = target.occupied
+
+        previous_hue = self._target_hue
+        previous_saturation = self._target_saturation
+        previous_brightness = self._target_brightness
+        previous_occupied = self._target_occupied
+
+        # float arrays compare element by element in Python, their bytes compare at memcmp speed
+        planes = (target_hue, target_saturation, target_brightness)
+        previous_planes = (previous_hue, previous_saturation, previous_brightness)
+        target_bytes = [bytes(target_occupied)] + [plane.tobytes() for plane in planes]
+        previous_bytes = [bytes(previous_occupied)] + [plane.tobytes() for plane in previous_planes]
+        if target_bytes == previous_bytes:
+            return
+
+        progress = self.progress
+        moving = self._moving
+        height = self.current.height
+        itemsize = target_hue.itemsize
+        for start in range(0, len(progress), height):
+            end = start + height
+            if (target_bytes[0][start:end] == previous_bytes[0][start:end] and
+                    all(current[start*itemsize:end*itemsize] == previous[start*itemsize:end*itemsize]
+                        for current, previous in zip(target_bytes[1:], previous_bytes[1:]))):
+                continue
+
+            cells = zip(range(start, end), target_occupied[start:end], target_hue[start:end],
+                        target_saturation[start:end], target_brightness[start:end],
+                        previous_occupied[start:end], previous_hue[start:end],
+                        previous_saturation[start:end], previous_brightness[start:end])
+            for i, t_occupied, t_hue, t_saturation, t_brightness, p_occupied, p_hue, p_saturation, p_brightness in cells:
+                if t_occupied != p_occupied or (t_occupied and (t_hue != p_hue or t_saturation != p_saturation or t_brightness != p_brightness)):
+                    progress[i] = 0.0
+                    moving.add(i)
+        previous_occupied[:] = target_occupied
+        previous_hue[:] = target_hue
+        previous_saturation[:] = target_saturation
+        previous_brightness[:] = target_brightness
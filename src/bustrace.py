@@ -0,0 +1,187 @@
+"""Fixed-size binary ring buffer of I2C transactions for post-mortem analysis, and a
+recorder writing every transaction to a log file for replay.py.
+
+Tracing is off unless enable() or record() was called, the bus code then only checks
+`buffer` for None.
+A dump starts with HEADER followed by the records, oldest first, each RECORD.size bytes:
+timestamp (float64, time.monotonic()), kind, bus number, address, register, payload length
+(uint8 each)
+and PAYLOAD_SIZE payload bytes, of which only the first `length` are valid.
+A log starts with LOG_HEADER followed by records of the same layout, but each one only
+carries its `length` payload bytes.
+"""
+
+import time
+import struct
+import itertools
+import threading
+
+HEADER = struct.Struct('<4sHHI')     # magic, version, record size, record count
+MAGIC = b'SHTR'
+VERSION = 2
+PAYLOAD_SIZE = 64
+RECORD = struct.Struct('<dBBBBB%ds' % PAYLOAD_SIZE)
+LOG_HEADER = struct.Struct('<4sH')  # magic, version
+LOG_MAGIC = b'SHTL'
+LOG_RECORD = struct.Struct('<dBBBBB')
+
+WRITE8 = 1
+WRITE16 = 2
+WRITE_RAW8 = 3
+WRITE_LIST = 4
+READ8 = 5
+READ16 = 6
+READ_LIST = 7
+ERROR = 8
+FRAME = 9           # marks the end of a frame written by IKEAShelf
+
+KIND_NAMES = {
+    WRITE8: 'write8',
+    WRITE16: 'write16',
+    WRITE_RAW8: 'writeRaw8',
+    WRITE_LIST: 'writeList',
+    READ8: 'read8',
+    READ16: 'read16',
+    READ_LIST: 'readList',
+    ERROR: 'error',
+    FRAME: 'frame',
+}
+
+
+class TraceBuffer:
+    "Keeps the last `capacity` transactions. record() may be called from several threads."
+
+    def __init__(self, capacity=4096, dump_path=None):
+        self.capacity = capacity
+        self.dump_path = dump_path          # written on every bus error, if set
+        self._data = bytearray(capacity * RECORD.size)
+        self._counter = itertools.count()
+        self._recorded = 0
+
+    def record(self, kind, bus, address, register, payload=b''):
+        index = next(self._counter)
+        RECORD.pack_into(self._data, (index % self.capacity) * RECORD.size,
+                         time.monotonic(), kind, bus, address, register, min(len(payload), PAYLOAD_SIZE), bytes(payload))
+        self._recorded = index + 1
+
+    def error(self, bus, address, register=0):
+        "Records a bus error and writes the dump to dump_path"
+        self.record(ERROR, bus, address, register)
+        if self.dump_path is not None:
+            with open(self.dump_path, 'wb') as f:
+                f.write(self.dump())
+
+    def clear(self):
+        self._counter = itertools.count()
+        self._recorded = 0
+
+    def __len__(self):
+        return min(self._recorded, self.capacity)
+
+    def dump(self):
+        "All records as bytes, oldest first"
+        count = len(self)
+        if self._recorded <= self.capacity:
+            data = self._data[:count * RECORD.size]
+        else:
+            start = self._recorded % self.capacity * RECORD.size
+            data = self._data[start:] + self._data[:start]
+        return HEADER.pack(MAGIC, VERSION, RECORD.size, count) + bytes(data)
+
+
+class Recorder:
+    """Appends every transaction to a log file. Transactions are passed on to `next`, e.g.
+    a TraceBuffer, so recording and tracing can be combined."""
+
+    def __init__(self, path, next=None):
+        self.next = next
+        self._file = open(path, 'wb')
+        self._file.write(LOG_HEADER.pack(LOG_MAGIC, VERSION))
+        self._lock = threading.Lock()
+
+    def record(self, kind, bus, address, register, payload=b''):
+        payload = bytes(payload)
+        self._write(kind, bus, address, register, payload)
+        if self.next is not None:
+            self.next.record(kind, bus, address, register, payload)
+
+    def error(self, bus, address, register=0):
+        "Logs the error and flushes the log, `next` records the error itself"
+        self._write(ERROR, bus, address, register, b'', flush=True)
+        if self.next is not None:
+            self.next.error(bus, address, register)
+
+    def _write(self, kind, bus, address, register, payload, flush=False):
+        with self._lock:
+            self._file.write(LOG_RECORD.pack(time.monotonic(), kind, bus, address, register, len(payload)) + payload)
+            if flush:
+                self._file.flush()
+
+    def dump(self):
+        "Dump of the next TraceBuffer in the chain, None if only recording"
+        return self.next.dump() if self.next is not None else None
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def records(dump):
+    "Yields (timestamp, kind, bus, address, register, payload) of a dump or a log"
+    if dump[:len(LOG_MAGIC)] == LOG_MAGIC:
+        yield from _log_records(dump)
+        return
+    magic, version, record_size, count = HEADER.unpack_from(dump)
+    if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+        raise ValueError('Not a version %d bus trace' % VERSION)
+    for index in range(count):
+        timestamp, kind, bus, address, register, length, payload = RECORD.unpack_from(dump, HEADER.size + index * RECORD.size)
+        yield timestamp, kind, bus, address, register, payload[:length]
+
+def _log_records(log):
+    magic, version = LOG_HEADER.unpack_from(log)
+    if version != VERSION:
+        raise ValueError('Not a version %d bus log' % VERSION)
+    offset = LOG_HEADER.size
+    while offset + LOG_RECORD.size <= len(log):
+        timestamp, kind, bus, address, register, length = LOG_RECORD.unpack_from(log, offset)
+        offset += LOG_RECORD.size
+        yield timestamp, kind, bus, address, register, log[offset:offset + length]
+        offset += length
+
+def format_records(dump):
+    "Human readable lines of a dump"
+    lines = []
+    for timestamp, kind, bus, address, register, payload in records(dump):
+        lines.append('%14.6f %-10s bus %d 0x%02X reg 0x%02X %s' % (timestamp, KIND_NAMES.get(kind, kind), bus, address, register,
+                                                             ' '.join('%02X' % byte for byte in payload)))
+    return '\n'.join(lines)
+
+
+buffer = None
+
+def enable(capacity=4096, dump_path=None):
+    global buffer
+    buffer = TraceBuffer(capacity, dump_path)
+    return buffer
+
+def record(path):
+    "Starts recording all transactions to a log file, in addition to an enabled trace buffer"
+    global buffer
+    buffer = Recorder(path, next=buffer)
+    return buffer
+
+def disable():
+    "Stops tracing and recording"
+    global buffer
+    while buffer is not None:
+        if isinstance(buffer, Recorder):
+            buffer.close()
+            buffer = buffer.next
+        else:
+            buffer = None
+
+if __name__ == '__main__':
+    import sys
+    with open(sys.argv[1], 'rb') as f:
+        print(format_records(f.read()))
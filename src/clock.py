@@ -0,0 +1,88 @@
+import traceback
+import metrics
+
+
+class FrameClock:
+    """Drives all periodic work from one fixed-rate frame schedule.
+
+    Every frame first advances the simulation stages in fixed timesteps, then calls the
+    render stages with the elapsed time and finally the output stages. Frames are scheduled
+    relative to the start time, so the frame rate doesn't drift. Frames that are already
+    overdue when the loop gets to them are skipped instead of being run back to back."""
+
+    def __init__(self, loop, frame_interval=0.05, max_catch_up=5, logger=None):
+        self._loop = loop
+        self.frame_interval = frame_interval
+        self.max_catch_up = max_catch_up        # simulation steps per stage and frame
+        self.logger = logger
+        self.frames = 0
+        self.frames_skipped = 0
+
+        self._simulations = []      # [callback, frames per step, accumulated frames]
+        self._renders = []
+        self._outputs = []
+        self._start = None
+        self._frame_index = 0
+        self._handle = None
+
+        metrics.gauge('shelftris_frames_skipped', 'Frames skipped because the loop was overdue', lambda: self.frames_skipped)
+
+    def add_simulation(self, callback, interval):
+        "callback() is called once per `interval` seconds of simulated time"
+        frames_per_step = max(1, int(round(interval / self.frame_interval)))
+        self._simulations.append([callback, frames_per_step, 0])
+
+    def add_render(self, callback):
+        "callback(elapsed_time) is called once per frame"
+        self._renders.append(callback)
+
+    def add_output(self, callback):
+        "callback() is called once per frame after all render stages"
+        self._outputs.append(callback)
+
+    def start(self):
+        self._start = self._loop.time()
+        self._frame_index = 1
+        self._schedule()
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _schedule(self):
+        self._handle = self._loop.call_at(self._start + self._frame_index * self.frame_interval, self._frame)
+
+    def _frame(self):
+        due_index = max(int((self._loop.time() - self._start) / self.frame_interval), self._frame_index)
+        self.frames_skipped += due_index - self._frame_index
+        advanced_frames = due_index - self._frame_index + 1
+        self._frame_index = due_index + 1
+
+        for simulation in self._simulations:
+            callback, frames_per_step, accumulated = simulation
+            accumulated += advanced_frames
+            steps = 0
+            while accumulated >= frames_per_step and steps < self.max_catch_up:
+                self._call(callback)
+                accumulated -= frames_per_step
+                steps += 1
+            simulation[2] = accumulated % frames_per_step
+
+        elapsed_time = advanced_frames * self.frame_interval
+        for callback in self._renders:
+            self._call(callback, elapsed_time)
+
+        for callback in self._outputs:
+            self._call(callback)
+
+        self.frames += 1
+        self._schedule()
+
+    def _call(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception as ex:
+            output = traceback.format_exception(ex.__class__, ex, ex.__traceback__)
+            if self.logger is not None:
+                self.logger.critical(''.join(output))
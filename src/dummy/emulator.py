@@ -0,0 +1,199 @@
+import time
+import threading
+
+# ===========================================================================
+# Emulated I2C bus with PCA9685 devices, so the output path can be checked and
+# benchmarked off-Pi. Register behaviour follows the NXP PCA9685 datasheet
+# (rev. 4, section 7.3).
+# ===========================================================================
+
+
+class PCA9685(object):
+    "Register file of a PCA9685, including MODE1 auto-increment/sleep, ALL_LED and PRESCALE"
+
+    MODE1                = 0x00
+    MODE2                = 0x01
+    LED0_ON_L            = 0x06
+    LAST_LED_REGISTER    = 0x45
+    ALL_LED_ON_L         = 0xFA
+    ALL_LED_OFF_H        = 0xFD
+    PRESCALE             = 0xFE
+
+    RESTART              = 1 << 7
+    AI                   = 1 << 5
+    SLEEP                = 1 << 4
+    FULL                 = 1 << 4         # bit 4 of LEDn_ON_H / LEDn_OFF_H
+
+    LED_COUNT            = 16
+    OSCILLATOR           = 25000000
+
+    ALLCALL_ADDRESS      = 0x70           # power-up LED All Call address, answered by every device
+    # the 62 addresses the six address pins select, without LED All Call and 0x7F
+    ADDRESSES            = list(range(0x40, ALLCALL_ADDRESS)) + list(range(ALLCALL_ADDRESS + 1, 0x7F))
+
+    def __init__(self, address):
+        self.address = address
+        self.reset()
+
+    def reset(self):
+        "Power-up register values"
+        self.registers = bytearray(256)
+        self.registers[self.MODE1] = self.SLEEP | 0x01     # ALLCALL
+        self.registers[self.MODE2] = 0x04                  # OUTDRV
+        self.registers[self.PRESCALE] = 0x1E               # 200 Hz
+        for channel in range(self.LED_COUNT):
+            self.registers[self.LED0_ON_L + 4 * channel + 3] = self.FULL     # full off
+        self._pointer = 0
+
+    @property
+    def autoIncrement(self):
+        return bool(self.registers[self.MODE1] & self.AI)
+
+    @property
+    def sleeping(self):
+        return bool(self.registers[self.MODE1] & self.SLEEP)
+
+    @property
+    def frequency(self):
+        return self.OSCILLATOR / (4096 * (self.registers[self.PRESCALE] + 1))
+
+    def write(self, data):
+        "A write transaction: control register followed by data bytes"
+        if not data:
+            return
+        self._pointer = data[0]
+        for value in data[1:]:
+            self._store(self._pointer, value)
+            if self.autoIncrement:
+                self._pointer = self._nextRegister(self._pointer)
+
+    def read(self, length):
+        "A read transaction starting at the current control register"
+        result = []
+        for _ in range(length):
+            result.append(self._load(self._pointer))
+            if self.autoIncrement:
+                self._pointer = self._nextRegister(self._pointer)
+        return result
+
+    def _nextRegister(self, register):
+        "Auto-increment rolls over to MODE1 after the last LED register and after PRESCALE"
+        if register == self.LAST_LED_REGISTER or register >= self.PRESCALE:
+            return self.MODE1
+        return register + 1
+
+    def _store(self, register, value):
+        if self.LAST_LED_REGISTER < register < self.ALL_LED_ON_L:
+            return                                          # reserved
+        if self.ALL_LED_ON_L <= register <= self.ALL_LED_OFF_H:
+            offset = register - self.ALL_LED_ON_L
+            for channel in range(self.LED_COUNT):
+                self.registers[self.LED0_ON_L + 4 * channel + offset] = value
+            return
+        if register == self.PRESCALE and not self.sleeping:
+            return                                          # only writable in sleep mode
+        if register == self.MODE1:
+            value &= ~self.RESTART                          # writing RESTART clears it
+        self.registers[register] = value
+
+    def _load(self, register):
+        if self.ALL_LED_ON_L <= register <= self.ALL_LED_OFF_H:
+            return 0                                        # write only
+        return self.registers[register]
+
+    def pwm(self, channel):
+        "(on, off) counts and full on/off flags of a channel: (on, off, full_on, full_off)"
+        offset = self.LED0_ON_L + 4 * channel
+        registers = self.registers
+        on = registers[offset] | (registers[offset + 1] & 0x0F) << 8
+        off = registers[offset + 2] | (registers[offset + 3] & 0x0F) << 8
+        return on, off, bool(registers[offset + 1] & self.FULL), bool(registers[offset + 3] & self.FULL)
+
+    def duty(self, channel):
+        "Fraction of the PWM period the channel is on, 0 while sleeping"
+        on, off, full_on, full_off = self.pwm(channel)
+        if self.sleeping or full_off:
+            return 0.0
+        if full_on:
+            return 1.0
+        return ((off - on) % 4096) / 4096
+
+
+class EmulatedBus(object):
+    """An I2C bus with emulated devices. Transactions take as long as they would on the wire at
+    `frequency` (100 or 400 kHz); with `realtime` the caller is blocked for that time.
+
+    Transactions and bytes are counted in total and per frame, see endFrame()."""
+
+    GENERAL_CALL = 0x00
+    SWRST = 0x06
+
+    def __init__(self, frequency=400000, realtime=False, autoAttach=True):
+        self.frequency = frequency
+        self.realtime = realtime
+        self.autoAttach = autoAttach    # devices appear at any PCA9685 address they are accessed at
+        self.devices = {}               # address -> PCA9685
+        self.transactions = 0
+        self.bytes = 0
+        self.busyTime = 0.0
+        self.lastFrame = (0, 0, 0.0)    # transactions, bytes, seconds of the last finished frame
+        self._frameStart = (0, 0, 0.0)
+        self.lock = threading.RLock()
+
+    def device(self, address):
+        "Raises IOError like smbus if nothing answers at the address or it isn't a 7 bit address"
+        if not 0 <= address <= 0x7F:
+            raise IOError(22, 'Invalid argument')
+        if address not in self.devices:
+            if not self.autoAttach or address not in PCA9685.ADDRESSES:
+                raise IOError(121, 'Remote I/O error')
+            self.devices[address] = PCA9685(address)
+        return self.devices[address]
+
+    def answers(self, address):
+        if address == self.GENERAL_CALL:
+            return True
+        try:
+            self.device(address)
+            return True
+        except IOError:
+            return False
+
+    def write(self, address, data):
+        with self.lock:
+            if address == self.GENERAL_CALL:
+                self._transfer(len(data))
+                if list(data) == [self.SWRST]:
+                    for device in self.devices.values():
+                        device.reset()
+                return
+            device = self.device(address)
+            self._transfer(len(data))
+            device.write(data)
+
+    def read(self, address, register, length):
+        "Write of the control register followed by a read after a repeated start"
+        with self.lock:
+            device = self.device(address)
+            self._transfer(1, length)
+            device.write([register])
+            return device.read(length)
+
+    def _transfer(self, written, read=0):
+        # start, address byte + ack, 9 bits per data byte, stop; a read adds a repeated start and address byte
+        bits = 2 + 9 * (1 + written)
+        if read:
+            bits += 1 + 9 * (1 + read)
+        duration = bits / self.frequency
+        self.transactions += 1
+        self.bytes += written + read
+        self.busyTime += duration
+        if self.realtime:
+            time.sleep(duration)
+
+    def endFrame(self):
+        "Finishes the current frame, returns and stores its (transactions, bytes, seconds)"
+        transactions, count, busy = self._frameStart
+        self.lastFrame = (self.transactions - transactions, self.bytes - count, self.busyTime - busy)
+        self._frameStart = (self.transactions, self.bytes, self.busyTime)
+        return self.lastFrame
@@ -1,22 +1,8 @@
-class Driver(object):
-    @classmethod
-    def softwareReset(cls):
-        pass
+from adafruit import pca9685
+from .wirebus import I2C
 
-    def __init__(self, address=0x40, busnum=-1, logger=None):
-        pass
 
-    def wakeUp(self):
-        pass
-
-    def sleep(self):
-        pass
-
-    def setPWMFreq(self, freq):
-        pass
-
-    def setPWM(self, channel, on, off):
-        pass
-
-    def setAllPWM(self, on, off):
-        pass
+class Driver(pca9685.Driver):
+    "The real driver logic, talking to an emulated PCA9685 (see dummy.emulator)"
+    _I2C = I2C
+    OSCILLATOR_DELAY = 0
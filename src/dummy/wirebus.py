@@ -1,4 +1,14 @@
+import bustrace
+from .emulator import EmulatedBus
+
+
 class I2C(object):
+    "Same interface as adafruit.wirebus.I2C, talking to emulated devices instead of /dev/i2c-N"
+
+    busFrequency = 400000       # Hz, for buses created afterwards
+    realtime = False            # block for the time transactions would take on the wire
+    _buses = {}                 # bus number -> EmulatedBus
+
     @staticmethod
     def _piRevision():
         return 2
@@ -16,10 +26,112 @@ class I2C(object):
     def configurePinouts(cls, logger=None):
         pass
 
+    @classmethod
+    def sharedBus(cls, busnum=-1):
+        "Returns the EmulatedBus for the bus number, created on first use"
+        busnum = busnum if busnum >= 0 else cls.defaultBusNumber()
+        if busnum not in cls._buses:
+            cls._buses[busnum] = EmulatedBus(cls.busFrequency, realtime=cls.realtime)
+        return cls._buses[busnum]
+
+    @classmethod
+    def buses(cls):
+        "The EmulatedBus instances created so far"
+        return list(cls._buses.values())
+
+    @classmethod
+    def closeAllBuses(cls):
+        cls._buses.clear()
+
     @classmethod
     def isDeviceAnswering(cls, address, busnum=-1):
-        return True
+        return cls.sharedBus(busnum).answers(address)
+
+    @classmethod
+    def answeringDevices(cls, addresses, busnum=-1):
+        bus = cls.sharedBus(busnum)
+        return set(address for address in addresses if bus.answers(address))
 
 
     def __init__(self, address, busnum=-1, logger=None):
-        pass
+        self.logger = logger
+        self.address = address
+        self.busnum = busnum if busnum >= 0 else I2C.defaultBusNumber()
+        self.bus = I2C.sharedBus(self.busnum)
+
+    def errMsg(self):
+        if bustrace.buffer is not None:
+            bustrace.buffer.error(self.busnum, self.address)
+        if self.logger is not None:
+            self.logger.error("Error accessing 0x%02X: Check your I2C address", self.address)
+        return -1
+
+    def _write(self, kind, reg, data):
+        try:
+            self.bus.write(self.address, data)
+        except IOError as err:
+            return self.errMsg()
+        trace = bustrace.buffer
+        if trace is not None:
+            trace.record(kind, self.busnum, self.address, reg, data[1:])
+
+    def _read(self, kind, reg, length):
+        try:
+            result = self.bus.read(self.address, reg, length)
+        except IOError as err:
+            return None
+        trace = bustrace.buffer
+        if trace is not None:
+            trace.record(kind, self.busnum, self.address, reg, result)
+        return result
+
+    def write8(self, reg, value):
+        "Writes an 8-bit value to the specified register/address"
+        return self._write(bustrace.WRITE8, reg, [reg, value])
+
+    def write16(self, reg, value):
+        "Writes a 16-bit value to the specified register/address pair"
+        return self._write(bustrace.WRITE16, reg, [reg, value & 0xFF, value >> 8])
+
+    def writeRaw8(self, value):
+        "Writes an 8-bit value on the bus"
+        try:
+            self.bus.write(self.address, [value])
+        except IOError as err:
+            return self.errMsg()
+        trace = bustrace.buffer
+        if trace is not None:
+            trace.record(bustrace.WRITE_RAW8, self.busnum, self.address, 0, (value,))
+
+    def writeList(self, reg, list):
+        "Writes an array of bytes using I2C format, limited to 32 bytes like an SMBus block write"
+        if len(list) > 32:
+            return self.errMsg()
+        return self._write(bustrace.WRITE_LIST, reg, [reg] + [value for value in list])
+
+    def readList(self, reg, length):
+        "Read a list of bytes from the I2C device"
+        result = self._read(bustrace.READ_LIST, reg, length)
+        return self.errMsg() if result is None else result
+
+    def readU8(self, reg):
+        "Read an unsigned byte from the I2C device"
+        result = self._read(bustrace.READ8, reg, 1)
+        return self.errMsg() if result is None else result[0]
+
+    def readS8(self, reg):
+        "Reads a signed byte from the I2C device"
+        result = self.readU8(reg)
+        if result > 127: result -= 256
+        return result
+
+    def readU16(self, reg):
+        "Reads an unsigned 16-bit value from the I2C device"
+        result = self._read(bustrace.READ16, reg, 2)
+        return self.errMsg() if result is None else result[0] | result[1] << 8
+
+    def readS16(self, reg):
+        "Reads a signed 16-bit value from the I2C device"
+        result = self.readU16(reg)
+        if result > 32767: result -= 65536
+        return result
@@ -0,0 +1,113 @@
+"""Startup and idle animations as generators yielding one FrameBuffer per frame.
+
+Every effect is a generator function taking the grid size and the frame interval, further
+arguments are effect specific. Effects with a `duration` of None run until cancelled.
+Yielded frames aren't modified afterwards, so they can be output without copying.
+"""
+
+import math
+from collections import deque
+
+from shelftris import Color, FrameBuffer
+
+
+def _frames(duration, frame_interval):
+    "Frame numbers for `duration` seconds, endless for None"
+    frame = 0
+    while duration is None or frame * frame_interval < duration:
+        yield frame
+        frame += 1
+
+def sweep(width, height, frame_interval, cell_time=0.1, hold_time=0.5):
+    "Lights up one cell after the other in rainbow colors, then holds the full rainbow"
+    frame = FrameBuffer(width, height)
+    hue_step = 1.0 / (width * height)
+    frames_per_cell = max(1, int(round(cell_time / frame_interval)))
+    for index in range(width * height):
+        frame = frame.copy()
+        frame[divmod(index, height)] = Color((index + 1) * hue_step, 1, 1)
+        for _ in range(frames_per_cell):
+            yield frame
+    for _ in _frames(hold_time, frame_interval):
+        yield frame
+
+def rainbow(width, height, frame_interval, period=10.0, duration=None):
+    "All cells in rainbow colors, rotating through the hues once per `period` seconds"
+    cells = width * height
+    for number in _frames(duration, frame_interval):
+        offset = number * frame_interval / period
+        frame = FrameBuffer(width, height)
+        for index in range(cells):
+            frame[divmod(index, height)] = Color((offset + index / cells) % 1.0, 1, 1)
+        yield frame
+
+def breathing(width, height, frame_interval, color=Color(0.6, 1, 1), period=4.0, duration=None):
+    "All cells in one color, slowly fading in and out"
+    for number in _frames(duration, frame_interval):
+        brightness = (1 - math.cos(2 * math.pi * number * frame_interval / period)) / 2
+        frame = FrameBuffer(width, height)
+        for x in range(width):
+            for y in range(height):
+                frame[x, y] = Color(color.hue, color.saturation, color.brightness * brightness)
+        yield frame
+
+def chase(width, height, frame_interval, color=Color(0.0, 1, 1), cell_time=0.15, duration=None):
+    "A single lit cell running through the grid row by row"
+    cells = width * height
+    for number in _frames(duration, frame_interval):
+        index = int(number * frame_interval / cell_time) % cells
+        y, x = divmod(index, width)
+        frame = FrameBuffer(width, height)
+        frame[x, y] = color
+        yield frame
+
+EFFECTS = {
+    'sweep': sweep,
+    'rainbow': rainbow,
+    'breathing': breathing,
+    'chase': chase,
+}
+
+
+class EffectPlayer:
+    """Plays queued effects one after another, one frame per step().
+
+    Meant to be driven by a FrameClock simulation stage and used as one of IKEAShelf.overrides,
+    so effects render through the normal output path without blocking the event loop."""
+
+    def __init__(self, width, height, frame_interval):
+        self.width = width
+        self.height = height
+        self.frame_interval = frame_interval
+        self._queue = deque()
+        self._current = None
+        self._frame = None
+
+    def play(self, effect, **arguments):
+        "Queues effect(width, height, frame_interval, **arguments)"
+        self._queue.append(effect(self.width, self.height, self.frame_interval, **arguments))
+
+    def cancel(self):
+        "Stops the current effect and drops all queued ones"
+        self._queue.clear()
+        self._current = None
+        self._frame = None
+
+    def active(self):
+        return self._frame is not None
+
+    def state(self):
+        return self._frame
+
+    def step(self):
+        while True:
+            if self._current is None:
+                if not self._queue:
+                    self._frame = None
+                    return
+                self._current = self._queue.popleft()
+            try:
+                self._frame = next(self._current)
+                return
+            except StopIteration:
+                self._current = None
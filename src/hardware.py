@@ -1,105 +1,268 @@
 import helper
-import yaml
-import asyncio
-import traceback
+import metrics
+import bustrace
+import json
+import math
 import time
+import traceback
+import threading
+from array import array
 from shelftris import Color
 
-if helper.is_raspberry():
+if helper.use_hardware():
     from adafruit import wirebus
     from adafruit import pca9685
+    from adafruit import i2cdev
 else:
     from dummy import wirebus
     from dummy import pca9685
+    i2cdev = None
+
+_output_timer = metrics.histogram('shelftris_output_seconds', 'Duration of writing one frame to the hardware')
+
+
+def _clamp(value):
+    "Limits value to [0, 1], NaN becomes 0"
+    if not value > 0:
+        return 0.0
+    return value if value < 1 else 1.0
+
+def hsb_to_rgb12(hue, saturation, brightness):
+    """Integer version of colorsys.hsv_to_rgb, returning 12-bit [0, 4095] channel values.
+    Saturation and brightness are clamped to [0, 1], so one bad cell can't stop a frame."""
+    value = int(_clamp(brightness) * 4095)
+    saturation = int(_clamp(saturation) * 4095)
+    if saturation == 0:
+        return (value, value, value)
+
+    if not math.isfinite(hue):
+        hue = 0.0
+    hue = int(hue * 24576) % 24576                  # 6 sectors with 4096 steps each
+    sector = hue >> 12
+    fraction = hue & 4095
+    p = value * (4095 - saturation) // 4095
+    q = value * (16773120 - saturation * fraction) // 16773120              # 4095 * 4096
+    t = value * (16773120 - saturation * (4096 - fraction)) // 16773120
+
+    if sector == 0: return (value, t, p)
+    if sector == 1: return (q, value, p)
+    if sector == 2: return (p, value, t)
+    if sector == 3: return (p, q, value)
+    if sector == 4: return (t, p, value)
+    return (value, p, q)
+
+
+def close_buses():
+    "Closes the I2C bus handles shared by all drivers, once nothing writes to the shelf anymore"
+    wirebus.I2C.closeAllBuses()
+
+
+class Calibration:
+    "Per channel lookup tables mapping 12-bit brightness to the PWM count"
+    _tables = {}            # gamma -> table, shared between all compartments
+
+    def __init__(self, red=0.5, green=1.0, blue=2.0):
+        self.red = self._table(red)
+        self.green = self._table(green)
+        self.blue = self._table(blue)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(**config.get("gamma", {}))
+
+    @classmethod
+    def _table(cls, gamma):
+        gamma = float(gamma)
+        if gamma not in cls._tables:
+            cls._tables[gamma] = array('H', (int((value / 4095) ** gamma * 4095) for value in range(4096)))
+        return cls._tables[gamma]
 
 
 class Compartment:
-    def __init__(self, driver, red_outlet, green_outlet, blue_outlet, logger=None):
+    def __init__(self, driver, red_outlet, green_outlet, blue_outlet, calibration=None, logger=None):
         self.driver = driver
         self.red_outlet = red_outlet
         self.green_outlet = green_outlet
         self.blue_outlet = blue_outlet
+        self.calibration = calibration if calibration is not None else Calibration()
         self.logger = logger
 
-        self._color = None
+        self._hsb = None
 
     @property
     def color(self):
-        return self._color
+        if self._hsb is None:
+            return None
+        return Color(*self._hsb)
 
     @color.setter
     def color(self, new_color):
         if new_color is None:
-            new_color = Color(0, 0, 0)
+            self.set_hsb(0.0, 0.0, 0.0)
+        else:
+            self.set_hsb(new_color.hue, new_color.saturation, new_color.brightness)
+
+    def set_hsb(self, hue, saturation, brightness):
+        hsb = (hue, saturation, brightness)
+        if self._hsb == hsb: return
+
+        self._hsb = hsb
+        red, green, blue = hsb_to_rgb12(hue, saturation, brightness)
+        self.driver.queuePWMCounts(self.red_outlet, 0, self.calibration.red[red])
+        self.driver.queuePWMCounts(self.green_outlet, 0, self.calibration.green[green])
+        self.driver.queuePWMCounts(self.blue_outlet, 0, self.calibration.blue[blue])
+
+
+class FrameWriter:
+    "Writes frames on a dedicated thread. Holds a single frame, a newer one replaces an unwritten older one."
+
+    def __init__(self, write, logger=None):
+        self._write = write
+        self.logger = logger
+        self.frames_written = 0
+        self.frames_dropped = 0
+
+        self._frame = None
+        self._running = True
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='FrameWriter', daemon=True)
+        self._thread.start()
 
-        if self._color == new_color: return
+    def submit(self, frame):
+        "Hands a frame to the writer thread, never blocks on the bus"
+        with self._condition:
+            if self._frame is not None:
+                self.frames_dropped += 1
+            self._frame = frame
+            self._condition.notify()
 
-        self._color = new_color
-        rgb = self._color.rgb()
-        self.driver.setPWM(self.red_outlet, 0, rgb[0] ** 0.5)
-        self.driver.setPWM(self.green_outlet, 0, rgb[1])
-        self.driver.setPWM(self.blue_outlet, 0, rgb[2] ** 2)
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._frame is None and self._running:
+                    self._condition.wait()
+                if not self._running:
+                    return
+                frame = self._frame
+                self._frame = None
+
+            try:
+                self._write(frame)
+                self.frames_written += 1
+            except Exception as ex:
+                output = traceback.format_exception(ex.__class__, ex, ex.__traceback__)
+                if self.logger is not None:
+                    self.logger.critical(''.join(output))
 
 
 class IKEAShelf:
-    def __init__(self, loop, view, logger=None):
-        self._loop = loop
+    def __init__(self, view, config=None, logger=None, combined_transfers=False):
+        """combined_transfers writes each frame to all drivers with one I2C_RDWR transfer
+        instead of one SMBus block write per changed register range"""
         self.logger = logger
         self.view = view
-        self.update_interval = 0.05
-        self.drivers = {}    # driver_address -> driver
+        self.drivers = {}    # (bus number, driver_address) -> driver
         self.compartments = helper.array_2d(self.view.width, self.view.height)
+        self._outputs = []   # (frame index, compartment)
+        self.overrides = []  # frame sources with active() and state(), the first active one is output instead of the view
+        self.writer = None
+        self.time_to_first_frame = None
+        self.buses = {}      # bus number -> (i2cdev.Bus, drivers on it) for combined transfers
+        self._combined_transfers = combined_transfers and i2cdev is not None
 
-        with open(helper.relative_path('..', 'conf', 'IKEA.json')) as f:
-            self._parse_config(yaml.load(f))
+        if config is None:
+            with open(helper.relative_path('..', 'conf', 'IKEA.json')) as f:
+                config = json.load(f)
+        self._parse_config(config)
 
-        asyncio.async(self.update(), loop=loop)
+        self.writer = FrameWriter(self._write_frame, logger=self.logger)
+        metrics.gauge('shelftris_frames_written', 'Frames written to the hardware', lambda: self.writer.frames_written if self.writer else 0)
+        metrics.gauge('shelftris_time_to_first_frame_seconds', 'Time from startup until the first frame was written', lambda: self.time_to_first_frame or 0)
+        metrics.gauge('shelftris_frames_dropped', 'Frames replaced by a newer one before being written', lambda: self.writer.frames_dropped if self.writer else 0)
 
 
     def __del__(self):
+        self.close()
+
+    def close(self):
+        "Stops the writer thread and turns all LEDs off"
+        if self.writer is None:
+            return
+        self.writer.stop()
+        self.writer = None
         for _, driver in self.drivers.items():
             driver.setAllPWM(0, 0)
+        for bus, _ in self.buses.values():
+            bus.close()
+        self.buses = {}
 
-    def _parse_config(self, config):
-        def driver_for_address(drivers, address):
-            if address not in drivers:
-                if not wirebus.I2C.isDeviceAnswering(address):
-                    return None
+    @staticmethod
+    def _driver_key(square):
+        "(bus number, address) of a config entry, the bus defaults to the default I2C bus"
+        return (square.get("bus", wirebus.I2C.defaultBusNumber()), int(square["driver_address"], 16))
 
-                driver = pca9685.Driver(address, logger=self.logger)
-                drivers[address] = driver
-            return drivers[address]
+    def _parse_config(self, config):
+        keys = sorted(set(self._driver_key(square) for square in config))
+        for busnum in sorted(set(busnum for busnum, _ in keys)):
+            addresses = [address for driver_bus, address in keys if driver_bus == busnum]
+            answering = wirebus.I2C.answeringDevices(addresses, busnum)
+            drivers = []
+            for address in addresses:
+                if address in answering:
+                    driver = pca9685.Driver(address, busnum=busnum, logger=self.logger, waitForOscillator=False)
+                    self.drivers[(busnum, address)] = driver
+                    drivers.append(driver)
+            if self._combined_transfers and drivers:
+                self.buses[busnum] = (i2cdev.Bus(busnum, logger=self.logger), drivers)
+        if self.drivers:
+            time.sleep(pca9685.Driver.OSCILLATOR_DELAY)          # once for all drivers
 
         for square in config:
-            driver_address = int(square["driver_address"], 16)
-            driver = driver_for_address(self.drivers, driver_address)
+            busnum, driver_address = self._driver_key(square)
+            driver = self.drivers.get((busnum, driver_address))
             if driver is None:
-                if logger is not None:
-                    logger.critical("No driver found for at address 0x%02X", dirver_address)
-                return
-            compartment = Compartment(driver, square["red"], square["green"], square["blue"], logger=self.logger)
-            self.compartments[square["position"][0]][square["position"][1]] = compartment
-
-    def demo_cycle(self):
-        hue_step = 1.0 / (self.view.width * self.view.height)
-        hue = hue_step 
-        for (x, y, color) in helper.column_wise(self.compartments):
-            if self.compartments[x][y] is not None:
-                self.compartments[x][y].color = Color(hue, 1, 1)
-                time.sleep(0.1)
-                hue = hue + hue_step
-        time.sleep(0.5)
-
-    @asyncio.coroutine
-    def update(self):
-        while True:
-            try:
-                for (x, y, color) in helper.row_wise(self.view.state()):
-                    if self.compartments[x][y] is not None:
-                        self.compartments[x][y].color = color
-            except Exception as ex:
-                output = traceback.format_exception(ex.__class__, ex, ex.__traceback__)
                 if self.logger is not None:
-                    self.logger.critical(''.join(output))
-            yield from asyncio.sleep(self.update_interval)
+                    self.logger.critical("No driver found for at address 0x%02X on bus %d", driver_address, busnum)
+                return
+            calibration = Calibration.from_config(square)
+            compartment = Compartment(driver, square["red"], square["green"], square["blue"], calibration=calibration, logger=self.logger)
+            x, y = square["position"]
+            self.compartments[x][y] = compartment
+            self._outputs.append((x * self.view.height + y, compartment))
+
+    def flush(self):
+        if self.buses:
+            for bus, drivers in self.buses.values():
+                bus.flushDrivers(drivers)
+            return
+        for _, driver in self.drivers.items():
+            driver.flush()
+
+    def _write_frame(self, frame):
+        "Runs on the writer thread"
+        with _output_timer.time():
+            for index, compartment in self._outputs:
+                compartment.set_hsb(frame.hue[index], frame.saturation[index], frame.brightness[index])
+            self.flush()
+        trace = bustrace.buffer
+        if trace is not None:
+            trace.record(bustrace.FRAME, 0, 0, 0)
+        if self.time_to_first_frame is None:
+            self.time_to_first_frame = time.monotonic() - metrics.started
+            if self.logger is not None:
+                self.logger.info('first frame written %.3f s after startup', self.time_to_first_frame)
+
+    def output(self):
+        source = self.view
+        for override in self.overrides:
+            if override.active():
+                source = override
+                break
+        self.writer.submit(source.state())
 
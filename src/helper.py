@@ -3,8 +3,17 @@ import os
 def relative_path(*segments):
     return os.path.join(os.path.dirname(os.path.realpath(__file__)), *segments)
 
+_is_raspberry = None
+
 def is_raspberry():
-    return os.popen('uname').read() == 'Linux\n'
+    global _is_raspberry
+    if _is_raspberry is None:
+        _is_raspberry = os.uname().sysname == 'Linux'
+    return _is_raspberry
+
+def use_hardware():
+    "Whether to talk to the real I2C devices, SHELFTRIS_HARDWARE=dummy forces the dummy drivers"
+    return os.environ.get('SHELFTRIS_HARDWARE') != 'dummy' and is_raspberry()
 
 def array_2d(width, height):
     return [[None for _ in range(height)] for _ in range(width)]
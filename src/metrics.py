@@ -0,0 +1,118 @@
+import math
+import time
+from collections import OrderedDict
+
+started = time.monotonic()      # import time of this module, close enough to the process start
+
+
+class Histogram:
+    "Fixed memory duration histogram with logarithmic buckets from 1 µs to 100 s"
+    MINIMUM = 1e-6
+    BUCKETS_PER_DECADE = 10
+    DECADES = 8
+
+    def __init__(self, name, description=''):
+        self.name = name
+        self.description = description
+        self.buckets = [0] * (self.DECADES * self.BUCKETS_PER_DECADE + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        if seconds <= self.MINIMUM:
+            bucket = 0
+        else:
+            bucket = min(int(math.log10(seconds / self.MINIMUM) * self.BUCKETS_PER_DECADE) + 1, len(self.buckets) - 1)
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def time(self):
+        "Context manager observing the duration of its block"
+        return _Timer(self)
+
+    def upper_bound(self, bucket):
+        return self.MINIMUM * 10 ** (bucket / self.BUCKETS_PER_DECADE)
+
+    def quantile(self, q):
+        "Upper bound of the bucket containing the q-quantile, capped at the maximum seen"
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count > 0:
+                return min(self.upper_bound(bucket), self.max)
+        return self.max
+
+
+class _Timer:
+    __slots__ = ('_histogram', '_start')
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+
+    def __exit__(self, type, value, traceback):
+        self._histogram.observe(time.perf_counter() - self._start)
+        return False
+
+
+class Registry:
+    def __init__(self):
+        self._histograms = OrderedDict()
+        self._gauges = OrderedDict()        # name -> (description, callback)
+
+    def histogram(self, name, description=''):
+        if name not in self._histograms:
+            self._histograms[name] = Histogram(name, description)
+        return self._histograms[name]
+
+    def gauge(self, name, description, callback):
+        "Registers a value that's read through callback() whenever the metrics are exported"
+        self._gauges[name] = (description, callback)
+
+    def as_dict(self):
+        histograms = OrderedDict()
+        for name, histogram in self._histograms.items():
+            histograms[name] = OrderedDict([
+                ('count', histogram.count),
+                ('sum', histogram.sum),
+                ('p50', histogram.quantile(0.5)),
+                ('p99', histogram.quantile(0.99)),
+                ('max', histogram.max),
+            ])
+        gauges = OrderedDict((name, callback()) for name, (_, callback) in self._gauges.items())
+        return OrderedDict([('histograms', histograms), ('gauges', gauges)])
+
+    def as_prometheus(self):
+        lines = []
+        for name, histogram in self._histograms.items():
+            lines.append('# HELP %s %s' % (name, histogram.description))
+            lines.append('# TYPE %s summary' % name)
+            lines.append('%s{quantile="0.5"} %r' % (name, histogram.quantile(0.5)))
+            lines.append('%s{quantile="0.99"} %r' % (name, histogram.quantile(0.99)))
+            lines.append('%s_sum %r' % (name, histogram.sum))
+            lines.append('%s_count %d' % (name, histogram.count))
+            lines.append('# TYPE %s_max gauge' % name)
+            lines.append('%s_max %r' % (name, histogram.max))
+        for name, (description, callback) in self._gauges.items():
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s %r' % (name, callback()))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+def histogram(name, description=''):
+    return registry.histogram(name, description)
+
+def gauge(name, description, callback):
+    registry.gauge(name, description, callback)
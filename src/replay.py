@@ -0,0 +1,111 @@
+#!/usr/bin/env python3.4
+
+"""Replays a bus log recorded with `runner.py --record` (or a /trace dump) against the real
+drivers or the emulated PCA9685s, and reports the bus traffic and the achievable frame rate.
+
+Transactions are replayed at the recorded pace or as fast as possible (--max-speed). Block
+writes longer than an SMBus block, as recorded from the I2C_RDWR backend, are split up.
+"""
+
+import time
+import argparse
+from collections import OrderedDict
+
+import bustrace
+
+SMBUS_BLOCK_SIZE = 32
+
+
+def replay(records, wirebus, max_speed=False):
+    "Plays the records through the given wirebus module, returns the statistics"
+    devices = {}
+    def device(bus, address):
+        if (bus, address) not in devices:
+            devices[(bus, address)] = wirebus.I2C(address, busnum=bus)
+        return devices[(bus, address)]
+
+    statistics = OrderedDict([('transactions', 0), ('bytes', 0), ('frames', 0), ('errors', 0), ('recorded_errors', 0)])
+    first_timestamp = None
+    start = time.perf_counter()
+    for timestamp, kind, bus, address, register, payload in records:
+        if first_timestamp is None:
+            first_timestamp = timestamp
+        if not max_speed:
+            delay = (timestamp - first_timestamp) - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+        if kind == bustrace.FRAME:
+            statistics['frames'] += 1
+            continue
+        if kind == bustrace.ERROR:
+            statistics['recorded_errors'] += 1
+            continue
+
+        i2c = device(bus, address)
+        if kind == bustrace.WRITE8:
+            results = [i2c.write8(register, payload[0])]
+        elif kind == bustrace.WRITE16:
+            results = [i2c.write16(register, payload[0] | payload[1] << 8)]
+        elif kind == bustrace.WRITE_RAW8:
+            results = [i2c.writeRaw8(payload[0])]
+        elif kind == bustrace.WRITE_LIST:
+            results = [i2c.writeList(register + offset, list(payload[offset:offset + SMBUS_BLOCK_SIZE]))
+                       for offset in range(0, len(payload), SMBUS_BLOCK_SIZE)]
+        elif kind == bustrace.READ8:
+            results = [i2c.readU8(register)]
+        elif kind == bustrace.READ16:
+            results = [i2c.readU16(register)]
+        elif kind == bustrace.READ_LIST:
+            results = [i2c.readList(register, len(payload))]
+        else:
+            continue
+        statistics['transactions'] += len(results)
+        statistics['bytes'] += len(payload) + len(results)        # data plus one register byte per transaction
+        statistics['errors'] += sum(1 for result in results if result == -1)
+
+    statistics['seconds'] = time.perf_counter() - start
+    if first_timestamp is not None:
+        statistics['recorded_seconds'] = timestamp - first_timestamp
+    return statistics
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('log', help="bus log or trace dump")
+    parser.add_argument('--max-speed', action='store_true', help="don't wait between transactions")
+    parser.add_argument('--hardware', action='store_true', help="replay on the real I2C bus instead of emulated PCA9685s")
+    parser.add_argument('--bus-frequency', type=int, default=400000, help="clock of the emulated bus in Hz, default: %(default)s")
+    parser.add_argument('--realtime', action='store_true', help="let emulated transactions take as long as on the wire")
+    args = parser.parse_args()
+
+    if args.hardware:
+        from adafruit import wirebus
+    else:
+        from dummy import wirebus
+        wirebus.I2C.busFrequency = args.bus_frequency
+        wirebus.I2C.realtime = args.realtime
+
+    with open(args.log, 'rb') as f:
+        log = f.read()
+
+    try:
+        statistics = replay(bustrace.records(log), wirebus, max_speed=args.max_speed)
+        if not args.hardware:
+            statistics['bus_seconds'] = sum(bus.busyTime for bus in wirebus.I2C.buses())
+    finally:
+        wirebus.I2C.closeAllBuses()
+
+    frames = statistics['frames']
+    print("%d transactions, %d bytes, %d frames in %.3f s" % (statistics['transactions'], statistics['bytes'], frames, statistics['seconds']))
+    if 'recorded_seconds' in statistics:
+        print("recorded duration: %.3f s" % statistics['recorded_seconds'])
+    if statistics['errors'] or statistics['recorded_errors']:
+        print("errors: %d (%d in the recording)" % (statistics['errors'], statistics['recorded_errors']))
+    if frames:
+        print("per frame: %.1f transactions, %.1f bytes" % (statistics['transactions'] / frames, statistics['bytes'] / frames))
+        print("achieved: %.1f fps" % (frames / statistics['seconds']))
+        if statistics.get('bus_seconds'):
+            print("bus limit at %d Hz: %.1f fps" % (args.bus_frequency, frames / statistics['bus_seconds']))
+
+if __name__ == '__main__':
+    main()
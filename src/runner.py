@@ -1,48 +1,101 @@
 #!/usr/bin/env python3.4
 
 import asyncio
+import argparse
 import logging
 import logging.config
 import yaml
+import bustrace
 
 from shelftris import *
-from hardware import IKEAShelf
+from hardware import IKEAShelf, close_buses
+from clock import FrameClock
 from webserver import WebServer
+from streaming import FrameStream
+from udpinput import FrameReceiver
+from effects import EffectPlayer, EFFECTS, sweep
+from autoplayer import AutoPlayer
+from concurrent.futures import ProcessPoolExecutor
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--autoplay', action='store_true', help="let the autoplayer play unattended")
+    parser.add_argument('--lookahead', type=int, default=2, help="pieces the autoplayer looks ahead")
+    parser.add_argument('--idle-effect', choices=sorted(EFFECTS), default=None, help="effect shown after the startup sweep until the first command")
+    parser.add_argument('--i2c-rdwr', action='store_true', help="write frames with combined I2C_RDWR transfers")
+    parser.add_argument('--trace', type=int, default=0, metavar='N', help="keep the last N bus transactions, served on /trace")
+    parser.add_argument('--trace-dump', default=None, metavar='PATH', help="write the bus trace to this file on every bus error")
+    parser.add_argument('--record', default=None, metavar='PATH', help="record all bus transactions to this file, see replay.py")
+    parser.add_argument('--udp-port', type=int, default=None, help="accept raw frames over UDP on this port")
+    parser.add_argument('--stream-rate', type=float, default=10, help="max frames per second streamed on /frames")
+    args = parser.parse_args()
+
     with open(helper.relative_path('..', 'conf', 'logging_conf.yaml')) as f:
         logging.config.dictConfig(yaml.load(f))
 
     logger = logging.getLogger('debug')
 
+    if args.trace > 0:
+        bustrace.enable(args.trace, dump_path=args.trace_dump)
+    if args.record is not None:
+        bustrace.record(args.record)
+
     loop = asyncio.get_event_loop()
     loop.set_debug(True)
 
     for sig in (signal.SIGINT, signal.SIGTERM):
         loop.add_signal_handler(sig, loop.stop)
 
-    game = Game(loop, 2, 4, logger=logger)
-    colorView = ColorBlendingView(loop, game)
-    shelf = IKEAShelf(loop, colorView, logger=logger)
+    clock = FrameClock(loop, frame_interval=0.05, logger=logger)
+    game = Game(2, 4, logger=logger)
+    colorView = ColorBlendingView(game)
+    shelf = IKEAShelf(colorView, logger=logger, combined_transfers=args.i2c_rdwr)
+    frameStream = FrameStream(colorView, max_rate=args.stream_rate)
+
+    clock.add_simulation(game.step, game.update_interval)
+    clock.add_render(colorView.blend)
+    clock.add_output(shelf.output)
+    clock.add_output(frameStream.publish)
 
     # consoleView = ConsoleStateView(loop, game, in_place=True)
-    
-    #     shape = random.choice(list(Shape))
-    #     x = random.randrange(self.field.width - len(shape.value))
-    #     y = 0
-    #     brick = Brick(shape, random.choice(colors), x, y)
-    #     brick.gravity_affected = True
-    #     self.place_brick(brick)
+
+    executor = None
+    if args.autoplay:
+        executor = ProcessPoolExecutor()
+        autoplayer = AutoPlayer(game, lookahead=args.lookahead, executor=executor)
+        clock.add_simulation(autoplayer.step, clock.frame_interval)
+
+    effects = EffectPlayer(colorView.width, colorView.height, clock.frame_interval)
+    effects.play(sweep)
+    if args.idle_effect is not None:
+        effects.play(EFFECTS[args.idle_effect])
+    clock.add_simulation(effects.step, clock.frame_interval)
+
+    udpTransport = None
+    if args.udp_port is not None:
+        receiver = FrameReceiver(colorView.width, colorView.height, logger=logger)
+        udpTransport, _ = loop.run_until_complete(loop.create_datagram_endpoint(lambda: receiver, local_addr=('0.0.0.0', args.udp_port)))
+        shelf.overrides.append(receiver)
+    shelf.overrides.append(effects)
 
     server = WebServer(loop=loop, logger=logger)
     server.game = game
+    server.frame_stream = frameStream
+    server.effects = effects
 
     try:
         with server:
-            shelf.demo_cycle()
+            clock.start()
             loop.run_forever()
     finally:
+        if udpTransport is not None:
+            udpTransport.close()
+        shelf.close()
+        close_buses()
+        bustrace.disable()
+        if executor is not None:
+            executor.shutdown()
         loop.close()
 
 if __name__ == '__main__':
@@ -7,10 +7,17 @@ import random
 import colorsys
 import signal
 import asyncio
+from array import array
 from enum import Enum
 # from termcolor import colored
 
 import helper
+import metrics
+import blending
+
+_tick_timer = metrics.histogram('shelftris_game_tick_seconds', 'Duration of a Game.step()')
+_state_timer = metrics.histogram('shelftris_game_state_seconds', 'Duration of a Game.state() snapshot')
+_blend_timer = metrics.histogram('shelftris_blend_seconds', 'Duration of a ColorBlendingView.blend()')
 
 def stringify(container, vertical_border = '', horizontal_border = ''):
     s = ''
@@ -122,6 +129,86 @@ class Color:
         return (self.hue, self.saturation, self.brightness)
 
 
+class FrameBuffer:
+    "Column-major HSB planes (float32) plus an occupancy mask. Empty cells are 0 in all planes."
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.clear()
+
+    def clear(self):
+        size = self.width * self.height
+        self.hue = array('f', [0.0]) * size
+        self.saturation = array('f', [0.0]) * size
+        self.brightness = array('f', [0.0]) * size
+        self.occupied = bytearray(size)
+
+    def index(self, x, y):
+        return x * self.height + y
+
+    def __getitem__(self, position):
+        index = self.index(*position)
+        if not self.occupied[index]:
+            return None
+        return Color(self.hue[index], self.saturation[index], self.brightness[index])
+
+    def __setitem__(self, position, color):
+        index = self.index(*position)
+        if color is None:
+            self.occupied[index] = 0
+            self.hue[index] = self.saturation[index] = self.brightness[index] = 0.0
+        else:
+            self.occupied[index] = 1
+            self.hue[index] = color.hue
+            self.saturation[index] = color.saturation
+            self.brightness[index] = color.brightness
+
+    def __len__(self):
+        return self.width
+
+    def __iter__(self):
+        "Yields columns of Color objects, so helper.column_wise and friends keep working"
+        for x in range(self.width):
+            yield [self[x, y] for y in range(self.height)]
+
+    def copy(self):
+        frame = FrameBuffer.__new__(FrameBuffer)
+        frame.width = self.width
+        frame.height = self.height
+        frame.hue = self.hue[:]
+        frame.saturation = self.saturation[:]
+        frame.brightness = self.brightness[:]
+        frame.occupied = self.occupied[:]
+        return frame
+
+    def copy_from(self, other):
+        self.hue[:] = other.hue
+        self.saturation[:] = other.saturation
+        self.brightness[:] = other.brightness
+        self.occupied[:] = other.occupied
+
+    def remove_row(self, row):
+        "Removes a row, moving all rows above it down by one and leaving an empty top row"
+        height = self.height
+        for start in range(0, self.width * height, height):
+            for plane in (self.hue, self.saturation, self.brightness):
+                plane[start + 1:start + row + 1] = plane[start:start + row]
+                plane[start] = 0.0
+            self.occupied[start + 1:start + row + 1] = self.occupied[start:start + row]
+            self.occupied[start] = 0
+
+    def set_all_saturation(self, saturation):
+        for index, occupied in enumerate(self.occupied):
+            if occupied:
+                self.saturation[index] = saturation
+
+    def set_all_brightness(self, brightness):
+        for index, occupied in enumerate(self.occupied):
+            if occupied:
+                self.brightness[index] = brightness
+
+
 class Shape(Enum):
      T = [[True, None], [True, True], [True, None]]
      O = [[True, True], [True, True]]
@@ -132,15 +219,41 @@ class Shape(Enum):
      S = [[None, True], [True, True], [True, None]]
      
 
+def _rotate_cw(pattern):
+    pattern = [list(column) for column in zip(*pattern)]
+    pattern.reverse()
+    return pattern
+
+def _rotations(shape):
+    "The four clockwise rotations of a shape as (pattern, column masks) with bit y set for occupied cells"
+    rotations = []
+    pattern = shape.value
+    for _ in range(4):
+        masks = tuple(sum(1 << y for y, value in enumerate(column) if value is not None) for column in pattern)
+        rotations.append((pattern, masks))
+        pattern = _rotate_cw(pattern)
+    return rotations
+
+_ROTATIONS = {shape: _rotations(shape) for shape in Shape}
+
+
 class Brick:
     def __init__(self, shape, color, x, y):
         self.shape = shape
+        self.color = color
         self.position = (x, y)
         self.gravity_affected = True
-        self.pattern = copy.deepcopy(shape.value)
-        for (x, y, value) in helper.column_wise(self.pattern):
-            if value is None: continue
-            self.pattern[x][y] = color
+        self.rotation = 0
+        self._apply_rotation()
+
+    @staticmethod
+    def rotation_masks(shape):
+        "Column masks of the four clockwise rotations of a shape, indexed by rotation, bit y set for occupied cells"
+        return [masks for _, masks in _ROTATIONS[shape]]
+
+    def _apply_rotation(self):
+        pattern, self.masks = _ROTATIONS[self.shape][self.rotation]
+        self.pattern = [[None if value is None else self.color for value in column] for column in pattern]
         
     @property
     def x(self):
@@ -152,64 +265,147 @@ class Brick:
     
     @property
     def width(self):
-        return len(self.pattern)
+        return len(self.masks)
     
     @property
     def height(self):
         return len(self.pattern[0])
 
     def set_saturation(self, saturation):
-        for (x, y, color) in helper.column_wise(self.pattern):
-            color.saturation = saturation
+        self.color.saturation = saturation
 
     def set_brightness(self, brightness):
-        for (x, y, color) in helper.column_wise(self.pattern):
-            color.brightness = brightness
+        self.color.brightness = brightness
     
     def __str__(self):
         return stringify(self.pattern)
 
     def rotate_cw(self):
-        self.pattern = list(zip(*self.pattern))
-        self.pattern.reverse()
+        self.rotation = (self.rotation + 1) % 4
+        self._apply_rotation()
 
     def rotate_ccw(self):
-        self.pattern.reverse()
-        self.pattern = list(zip(*self.pattern))
+        self.rotation = (self.rotation + 3) % 4
+        self._apply_rotation()
+
+
+def column_height(column, height):
+    "Stack height of a column bitboard (bit y set for occupied row y), measured from the bottom"
+    if column == 0:
+        return 0
+    return height - ((column & -column).bit_length() - 1)
+
+def drop_distance(columns, height, masks, x, y):
+    "Number of rows the brick column masks at (x, y) can fall in the column bitboards before they land"
+    distance = height - (y + max(mask.bit_length() for mask in masks))
+    for offset, mask in enumerate(masks):
+        bottom = y + mask.bit_length() - 1          # lowest cell of the brick in this column
+        column = columns[x + offset]
+        below = column >> (bottom + 1) if bottom >= -1 else column << -(bottom + 1)
+        if below:
+            distance = min(distance, (below & -below).bit_length() - 1)
+    return distance
 
 
 class Field:
     def __init__(self, width, height):
-        self.field = helper.array_2d(width, height)
+        self.field = FrameBuffer(width, height)     # colors
+        self._reset_occupancy()
+
+    def _reset_occupancy(self):
+        self.columns = [0] * self.width             # occupancy bitboards, bit y is set if (x, y) is occupied
+        self.row_counts = [0] * self.height         # occupied cells per row
+        self.heights = [0] * self.width             # stack height per column, measured from the bottom
     
     @property
     def width(self):
-        return len(self.field)
+        return self.field.width
     
     @property
     def height(self):
-        return len(self.field[0])
+        return self.field.height
 
     def clear(self):
-        self.field = helper.array_2d(self.width, self.height)
+        self.field.clear()
+        self._reset_occupancy()
+
+    def copy(self):
+        field = copy.copy(self)
+        field.field = self.field.copy()
+        field.columns = list(self.columns)
+        field.row_counts = list(self.row_counts)
+        field.heights = list(self.heights)
+        return field
+
+    def _occupy(self, x, y):
+        bit = 1 << y
+        if self.columns[x] & bit: return
+        self.columns[x] |= bit
+        self.row_counts[y] += 1
+        if self.height - y > self.heights[x]:
+            self.heights[x] = self.height - y
+
+    def _vacate(self, x, y):
+        bit = 1 << y
+        if not self.columns[x] & bit: return
+        self.columns[x] &= ~bit
+        self.row_counts[y] -= 1
+        self.heights[x] = column_height(self.columns[x], self.height)
+
+    def set_cell(self, x, y, color):
+        self.field[x, y] = color
+        if color is None:
+            self._vacate(x, y)
+        else:
+            self._occupy(x, y)
+
+    def set_cells(self, cells, hue=None, saturation=None, brightness=None):
+        """Sets the given color components of all (x, y) cells in one pass. With all three
+        components the cells become occupied, otherwise only occupied cells are changed."""
+        field = self.field
+        height = self.height
+        full = hue is not None and saturation is not None and brightness is not None
+        masks = {}          # x -> bits of cells to occupy
+        for x, y in cells:
+            index = x * height + y
+            if full:
+                field.occupied[index] = 1
+                masks[x] = masks.get(x, 0) | (1 << y)
+            elif not field.occupied[index]:
+                continue
+            if hue is not None: field.hue[index] = hue
+            if saturation is not None: field.saturation[index] = saturation
+            if brightness is not None: field.brightness[index] = brightness
+
+        for x, mask in masks.items():
+            added = mask & ~self.columns[x]
+            if not added: continue
+            self.columns[x] |= added
+            while added:
+                bit = added & -added
+                self.row_counts[bit.bit_length() - 1] += 1
+                added ^= bit
+            self.heights[x] = column_height(self.columns[x], self.height)
 
     def set_all_saturation(self, saturation):
-        for (x, y, color) in helper.column_wise(self.field):
-            color.saturation = saturation
+        self.field.set_all_saturation(saturation)
 
     def set_all_brightness(self, brightness):
-        for (x, y, color) in helper.column_wise(self.field):
-            color.brightness = brightness
+        self.field.set_all_brightness(brightness)
 
     def can_move(self, brick, new_position):
-        # return True
-        if (new_position[0] < 0 or
-                new_position[0] + brick.width  > self.width or
-                new_position[1] + brick.height > self.height):
+        x, y = new_position
+        if (x < 0 or
+                x + brick.width  > self.width or
+                y + brick.height > self.height):
             return False
-        for (x, y, color) in helper.column_wise(brick.pattern):
-            if color is None: continue
-            if self.field[new_position[0] + x][new_position[1] + y] is not None: return False
+        columns = self.columns
+        if y >= 0:
+            for offset, mask in enumerate(brick.masks):
+                if columns[x + offset] & (mask << y): return False
+        else:
+            for offset, mask in enumerate(brick.masks):
+                if columns[x + offset] & (mask >> -y): return False
         return True
 
     def is_outside(self, brick):
@@ -223,23 +419,69 @@ class Field:
         return stringify(self.field)
     
     def merge(self, brick):
-        # transfer brick.pattern to target
-        for (x, y, color) in helper.column_wise(brick.pattern):
-            if color is None: continue
-            if brick.x + x < 0 or brick.x + x >= self.width: continue
-            if brick.y + y < 0 or brick.y + y >= self.height: continue
-            self.field[brick.x + x][brick.y + y] = color
+        "Transfers the brick into the field, returns the affected rows"
+        rows = []
+        for row in range(brick.height):
+            y = brick.y + row
+            if 0 <= y < self.height:
+                rows.append(y)
+        for offset, mask in enumerate(brick.masks):
+            x = brick.x + offset
+            if x < 0 or x >= self.width: continue
+            for row in range(brick.height):
+                if not mask >> row & 1: continue
+                y = brick.y + row
+                if y < 0 or y >= self.height: continue
+                self.field[x, y] = brick.color
+                self._occupy(x, y)
+        return rows
+
+    def full_rows(self, rows=None):
+        if rows is None:
+            rows = range(self.height)
+        return [y for y in rows if self.row_counts[y] == self.width]
+
+    def clear_full_rows(self, rows=None):
+        "Removes all full rows (of the given candidates) and lets everything above collapse, returns the count"
+        full_rows = sorted(self.full_rows(rows))
+        for row in full_rows:                # top to bottom, so the indices of the remaining rows stay valid
+            self._remove_row(row)
+        return len(full_rows)
+
+    def _remove_row(self, row):
+        above = (1 << row) - 1
+        below = ~((1 << (row + 1)) - 1)
+        for x, column in enumerate(self.columns):
+            column = ((column & above) << 1) | (column & below)
+            self.columns[x] = column
+            self.heights[x] = column_height(column, self.height)
+        self.row_counts[1:row + 1] = self.row_counts[0:row]
+        self.row_counts[0] = 0
+        self.field.remove_row(row)
+
+    def drop_distance(self, brick, position=None):
+        "Number of rows the brick can fall from its (or the given) position before it lands"
+        x, y = position if position is not None else brick.position
+        return drop_distance(self.columns, self.height, brick.masks, x, y)
+
+    def ghost_position(self, brick):
+        "Position the brick would land on when dropped straight down"
+        return (brick.x, brick.y + self.drop_distance(brick))
 
 
 class Game:
-    def __init__(self, loop, width, height, logger=None):
-        self._loop = loop
+    """The game logic, independent of any clock or event loop.
+
+    step() advances the game by one tick of gravity, advance() by many at once.
+    run() drives the game in wall-clock time on an asyncio loop."""
+
+    def __init__(self, width, height, logger=None):
         self.field = Field(width, height)
         self.bricks = []
         self.logger = logger
         self.update_interval = 1
-
-        asyncio.async(self.update(), loop=loop)
+        self.ticks = 0
+        self.lines_cleared = 0
 
     @property
     def width(self):
@@ -249,25 +491,46 @@ class Game:
     def height(self):
         return self.field.height
 
-    @asyncio.coroutine
-    def update(self):
-        while True:
+    def step(self):
+        "Applies one tick of gravity, meant to be called every `update_interval` seconds"
+        with _tick_timer.time():
+            self.ticks += 1
             to_remove = []
             for brick in self.bricks:
                 new_position = (brick.x, brick.y +1)
                 if self.field.can_move(brick, new_position):
                     brick.position = new_position
                 else:
-                    self.field.merge(brick)
+                    self._land(brick)
                     to_remove.append(brick)
 
                 if self.field.is_outside(brick):
                     to_remove.append(brick)
             for brick in to_remove:
                 self.bricks.remove(brick)
+        
+    def advance(self, ticks):
+        "Fast forwards the game by the given number of ticks"
+        for _ in range(ticks):
+            self.step()
 
+    @asyncio.coroutine
+    def run(self):
+        "Steps the game in wall-clock time, for use without a FrameClock"
+        while True:
+            self.step()
             yield from asyncio.sleep(self.update_interval)
-        
+
+    def _land(self, brick):
+        rows = self.field.merge(brick)
+        self.lines_cleared += self.field.clear_full_rows(rows)
+
+    def hard_drop(self, brick):
+        "Instantly drops a falling brick onto the stack"
+        brick.position = self.field.ghost_position(brick)
+        self._land(brick)
+        self.bricks.remove(brick)
+
     def place_brick(self, brick):
         if brick.gravity_affected:
             self.bricks.append(brick)
@@ -285,11 +548,12 @@ class Game:
             brick.set_saturation = saturation
 
     def state(self):
-        "2D array of Color objects"
-        field = copy.deepcopy(self.field)
-        for brick in self.bricks:
-            field.merge(brick)
-        return field.field
+        "FrameBuffer snapshot of the field including all falling bricks"
+        with _state_timer.time():
+            field = self.field.copy()
+            for brick in self.bricks:
+                field.merge(brick)
+            return field.field
 
 
 class ConsoleStateView:
@@ -304,7 +568,7 @@ class ConsoleStateView:
     def update(self):
         while True:
             if self.in_place and self._needs_jump:
-                print("\033[%dA" % (len(self.stateful.state()[0]) + 3))
+                print("\033[%dA" % (self.stateful.height + 3))
             print(stringify(self.stateful.state(), vertical_border = '|', horizontal_border = '-'))
             self._needs_jump = True
 
@@ -312,59 +576,24 @@ class ConsoleStateView:
 
 
 class ColorBlendingView:
-    def __init__(self, loop, game):
-        self._loop = loop
+    def __init__(self, game, easing=blending.linear):
         self.game = game
-        self.update_interval = 0.05
         self.blend_time = 2
-        self.current_state = game.state()
-        self.previous_target = game.state()
-        self.blend_progress = game.state()
-        for (x, y, _) in helper.column_wise(self.current_state):
-            self.current_state[x][y] = None
-            self.previous_target[x][y] = None
-            self.blend_progress[x][y] = 0
-
-        asyncio.async(self.update(), loop=loop)
+        self.current_state = FrameBuffer(game.width, game.height)
+        self.blender = blending.Blender(self.current_state, easing=easing)
 
     @property
     def width(self):
-        return len(self.current_state)
+        return self.current_state.width
     
     @property
     def height(self):
-        return len(self.current_state[0])
-
-    @asyncio.coroutine
-    def update(self):
-        last_update = self._loop.time()
-        while True:
-            now = self._loop.time()
-            elapsed_time = now - last_update
-
-            game_state = self.game.state()
-            for (x, y, current_color) in helper.column_wise(self.current_state):
-                target_color = game_state[x][y]
-                if self.previous_target[x][y] != target_color:
-                    self.blend_progress[x][y] = 0
-                    self.previous_target[x][y] = target_color
-
-                if current_color == target_color:
-                    continue
-
-                if target_color is None:
-                    target_color = Color(hue = current_color.hue, saturation = current_color.saturation, brightness = 0)
+        return self.current_state.height
 
-                if current_color is None:
-                    current_color = Color(hue = target_color.hue, saturation = target_color.saturation, brightness = 0)
-                    self.current_state[x][y] = current_color
-
-                progress = min(self.blend_progress[x][y] + elapsed_time / self.blend_time, 1)
-                current_color.blend_towards(target_color, self.blend_progress[x][y], progress)
-                self.blend_progress[x][y] = progress
-
-            last_update = now
-            yield from asyncio.sleep(self.update_interval)
+    def blend(self, elapsed_time):
+        game_state = self.game.state()
+        with _blend_timer.time():
+            self.blender.advance(game_state, elapsed_time / self.blend_time)
 
     def state(self):
-        return copy.deepcopy(self.current_state)
+        return self.current_state.copy()
@@ -0,0 +1,98 @@
+import time
+import struct
+
+# Binary frame delta, all little endian:
+#   header: width (uint16), height (uint16), sequence (uint32), cell count (uint16)
+#   cells:  index (uint16, column-major: x * height + y), hue, saturation, brightness (uint8 each)
+# Empty cells are sent with all components 0. The first frame a client receives
+# contains all cells that aren't empty.
+HEADER = struct.Struct('<HHIH')
+CELL = struct.Struct('<HBBB')
+
+
+def quantize(frame):
+    "The HSB planes of a FrameBuffer as three byte strings"
+    return tuple(bytes(int(value * 255 + 0.5) for value in plane)
+                 for plane in (frame.hue, frame.saturation, frame.brightness))
+
+def encode_delta(previous, current, width, height, sequence):
+    "Encodes all cells of `current` that differ from `previous` (None for an empty frame)"
+    hue, saturation, brightness = current
+    if previous is None:
+        previous = (bytes(len(hue)),) * 3
+    previous_hue, previous_saturation, previous_brightness = previous
+
+    cells = []
+    if previous != current:
+        for index in range(len(hue)):
+            if (hue[index] != previous_hue[index] or
+                    saturation[index] != previous_saturation[index] or
+                    brightness[index] != previous_brightness[index]):
+                cells.append(CELL.pack(index, hue[index], saturation[index], brightness[index]))
+    return HEADER.pack(width, height, sequence, len(cells)) + b''.join(cells)
+
+
+class _Client:
+    def __init__(self, send, buffered):
+        self.send = send
+        self.buffered = buffered
+        self.frame = None       # quantized frame the client has last been sent
+        self.frames_dropped = 0
+
+
+class FrameStream:
+    """Publishes the frames of a view as deltas to any number of subscribers.
+
+    At most `max_rate` frames per second are taken from the view, one state() per frame
+    no matter how many clients are subscribed. Clients with more than `max_buffer` bytes
+    waiting in their send buffer skip frames, their next delta covers everything they missed."""
+
+    def __init__(self, view, max_rate=10, max_buffer=65536):
+        if view.width * view.height > 65535:
+            raise ValueError('Frame streaming supports at most 65535 cells, the cell count of a delta is a uint16')
+        self.view = view
+        self.max_rate = max_rate
+        self.max_buffer = max_buffer
+        self.sequence = 0
+        self._frame = None
+        self._last_publish = None
+        self._clients = set()
+
+    def subscribe(self, send, buffered):
+        """send(packet) delivers a packet to the client, buffered() returns the number of bytes
+        still waiting to be sent"""
+        client = _Client(send, buffered)
+        self._clients.add(client)
+        return client
+
+    def unsubscribe(self, client):
+        self._clients.discard(client)
+
+    def publish(self):
+        if not self._clients:
+            return
+        now = time.monotonic()
+        if self._last_publish is not None and now - self._last_publish < 1.0 / self.max_rate:
+            return
+        self._last_publish = now
+
+        previous = self._frame
+        frame = quantize(self.view.state())
+        if frame == previous and all(client.frame is previous for client in self._clients):
+            return
+        self._frame = frame
+        self.sequence += 1
+
+        shared = None
+        for client in list(self._clients):
+            if client.buffered() > self.max_buffer:
+                client.frames_dropped += 1
+                continue
+            if client.frame is previous and previous is not None:
+                if shared is None:
+                    shared = encode_delta(previous, frame, self.view.width, self.view.height, self.sequence)
+                packet = shared
+            else:
+                packet = encode_delta(client.frame, frame, self.view.width, self.view.height, self.sequence)
+            client.send(packet)
+            client.frame = frame
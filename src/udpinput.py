@@ -0,0 +1,91 @@
+import time
+import struct
+import asyncio
+import colorsys
+from array import array
+
+from shelftris import FrameBuffer
+
+# Frame packet, all little endian:
+#   header: magic b'SF', format (uint8, FORMAT_HSB or FORMAT_RGB), sequence (uint32)
+#   cells:  3 bytes (hue, saturation, brightness or red, green, blue) for every cell,
+#           column-major like FrameBuffer: x * height + y
+HEADER = struct.Struct('<2sBI')
+MAGIC = b'SF'
+FORMAT_HSB = 0
+FORMAT_RGB = 1
+
+
+def _newer(sequence, previous):
+    "Serial number arithmetic (RFC 1982) on 32 bits, so senders may wrap around"
+    return 0 < (sequence - previous) & 0xFFFFFFFF < 0x80000000
+
+
+class FrameReceiver(asyncio.DatagramProtocol):
+    """Receives complete frames over UDP, bypassing the game and the blending.
+
+    Used as one of IKEAShelf.overrides: while packets arrive it's active() and its frames are
+    output instead of the view's. Packets older than the last accepted one are dropped. After
+    `timeout` seconds without a packet the shelf falls back to the view and the next packet is
+    accepted whatever its sequence number, so senders can restart."""
+
+    def __init__(self, width, height, timeout=1.0, logger=None):
+        self.width = width
+        self.height = height
+        self.timeout = timeout
+        self.logger = logger
+        self.frame = FrameBuffer(width, height)
+        self.sequence = None
+        self.last_received = None
+        self.packets_received = 0
+        self.packets_dropped = 0
+        self.packets_invalid = 0
+        self._packet_size = HEADER.size + 3 * width * height
+
+    def active(self):
+        return self.last_received is not None and time.monotonic() - self.last_received < self.timeout
+
+    def state(self):
+        "Frames are never modified after being received, so there's nothing to copy"
+        return self.frame
+
+    def datagram_received(self, data, address):
+        if len(data) != self._packet_size:
+            self.packets_invalid += 1
+            return
+        magic, format, sequence = HEADER.unpack_from(data)
+        if magic != MAGIC or format not in (FORMAT_HSB, FORMAT_RGB):
+            self.packets_invalid += 1
+            return
+        if self.active() and not _newer(sequence, self.sequence):
+            self.packets_dropped += 1
+            return
+
+        cells = data[HEADER.size:]
+        if format == FORMAT_RGB:
+            cells = self._rgb_to_hsb(cells)
+        self.frame = self._decode(cells)
+        self.sequence = sequence
+        self.last_received = time.monotonic()
+        self.packets_received += 1
+
+    def error_received(self, ex):
+        if self.logger is not None:
+            self.logger.error('UDP frame input: %s', ex)
+
+    def _decode(self, cells):
+        frame = FrameBuffer(self.width, self.height)
+        frame.hue = array('f', (value / 255 for value in cells[0::3]))
+        frame.saturation = array('f', (value / 255 for value in cells[1::3]))
+        frame.brightness = array('f', (value / 255 for value in cells[2::3]))
+        frame.occupied = bytearray(1 if h or s or b else 0 for h, s, b in zip(cells[0::3], cells[1::3], cells[2::3]))
+        return frame
+
+    def _rgb_to_hsb(self, cells):
+        hsb = bytearray(len(cells))
+        for index in range(0, len(cells), 3):
+            hue, saturation, _ = colorsys.rgb_to_hsv(cells[index] / 255, cells[index + 1] / 255, cells[index + 2] / 255)
+            hsb[index] = int(hue * 255 + 0.5)
+            hsb[index + 1] = int(saturation * 255 + 0.5)
+            hsb[index + 2] = max(cells[index:index + 3])
+        return hsb
@@ -1,19 +1,38 @@
 import asyncio
 import traceback
 import os
+import json
+import aiohttp
 from aiohttp import web
 from shelftris import *
+import metrics
+import bustrace
+
+
+class CommandError(Exception):
+    pass
+
 
 class WebServer:
+    COMPONENTS = ("hue", "saturation", "brightness")
+    COMPONENT_ACTIONS = {"set_" + component: component for component in COMPONENTS}
+
     def __init__(self, loop, logger=None):
         self._loop = loop
         self.ip = '0.0.0.0'
         self.port = 80
         self.game = None
+        self.frame_stream = None
+        self.effects = None
         self.logger = logger
 
         self._app = web.Application(loop=self._loop)
         self._app.router.add_route('POST', '/command', self._handle)
+        self._app.router.add_route('POST', '/commands', self._handle_batch)
+        self._app.router.add_route('GET', '/ws', self._handle_websocket)
+        self._app.router.add_route('GET', '/frames', self._handle_frames)
+        self._app.router.add_route('GET', '/metrics', self._handle_metrics)
+        self._app.router.add_route('GET', '/trace', self._handle_trace)
 
 
     def __enter__(self):
@@ -56,18 +75,116 @@ class WebServer:
 
             # self.logger.info(command)
 
-            if command["action"] == "system":
-                return self._handle_system(command)
-            if command["action"] == "add_brick":
-                return self._handle_add_brick(command)
-            if command["action"] == "clear":
-                return self._handle_clear(command)
+            return self._execute(command)
+        except Exception as ex:
+            self._log_exception(ex)
+
+    def _log_exception(self, ex):
+        output = traceback.format_exception(ex.__class__, ex, ex.__traceback__)
+        if self.logger is not None:
+            self.logger.critical(''.join(output))
+
+    def _execute(self, command):
+        "Runs a single command, returns the HTTP response"
+        self._cancel_effects()
+        if command["action"] == "system":
+            return self._handle_system(command)
+        if command["action"] == "add_brick":
+            return self._handle_add_brick(command)
+        if command["action"] == "clear":
+            return self._handle_clear(command)
+        if command["action"] in ("set_cell", "set_cells", "set_hue", "set_saturation", "set_brightness"):
+            try:
+                self._parse_command(command)()
+            except CommandError:
+                return web.HTTPBadRequest()
+            return web.HTTPOk()
+
+        return web.HTTPNotFound()
+
+    @asyncio.coroutine
+    def _handle_websocket(self, request):
+        """Accepts the /command vocabulary as a stream of JSON messages, answering each one in order
+        with {"id": <id of the message>, "status": <HTTP status code>}. Clients don't need to wait
+        for an acknowledgement before sending the next message. A message of the form
+        {"id": ..., "commands": [...]} is applied like a POST to /commands."""
+        ws = web.WebSocketResponse()
+        ws.start(request)
 
+        while True:
+            message = yield from ws.receive()
+            if message.tp == aiohttp.MsgType.text:
+                ws.send_str(json.dumps(self._acknowledge(message.data)))
+            elif message.tp in (aiohttp.MsgType.close, aiohttp.MsgType.closed, aiohttp.MsgType.error):
+                break
+
+        return ws
+
+    @asyncio.coroutine
+    def _handle_frames(self, request):
+        """Streams the rendered frames as binary deltas, see streaming.py for the encoding.
+        Messages sent by the client are ignored."""
+        if self.frame_stream is None:
             return web.HTTPNotFound()
-        except Exception as ex:
-            output = traceback.format_exception(ex.__class__, ex, ex.__traceback__)
-            if self.logger is not None:
-                self.logger.critical(''.join(output))
+
+        ws = web.WebSocketResponse()
+        ws.start(request)
+
+        client = self.frame_stream.subscribe(ws.send_bytes, request.transport.get_write_buffer_size)
+        try:
+            while True:
+                message = yield from ws.receive()
+                if message.tp in (aiohttp.MsgType.close, aiohttp.MsgType.closed, aiohttp.MsgType.error):
+                    break
+        finally:
+            self.frame_stream.unsubscribe(client)
+
+        return ws
+
+    def _acknowledge(self, data):
+        try:
+            message = json.loads(data)
+        except ValueError:
+            return {"id": None, "status": 400, "error": "invalid JSON"}
+        if not isinstance(message, dict):
+            return {"id": None, "status": 400, "error": "message is not an object"}
+
+        acknowledgement = {"id": message.get("id")}
+        if self.game is None:
+            acknowledgement["status"] = 500
+        elif "commands" in message:
+            status, body = self._apply_batch(message["commands"])
+            acknowledgement.update(body)
+            acknowledgement["status"] = status
+        else:
+            try:
+                acknowledgement["status"] = self._execute(message).status
+            except (KeyError, TypeError, ValueError) as ex:
+                acknowledgement["status"] = 400
+                acknowledgement["error"] = repr(ex)
+            except Exception as ex:
+                self._log_exception(ex)
+                acknowledgement["status"] = 500
+        return acknowledgement
+
+    @asyncio.coroutine
+    def _handle_metrics(self, request):
+        """Frame timing histograms and counters, Prometheus text format by default or JSON with ?format=json"""
+        if request.GET.get('format') == 'json':
+            body = json.dumps(metrics.registry.as_dict())
+            return web.Response(body=body.encode('utf-8'), content_type='application/json')
+        body = metrics.registry.as_prometheus()
+        return web.Response(body=body.encode('utf-8'), content_type='text/plain')
+
+    @asyncio.coroutine
+    def _handle_trace(self, request):
+        """Dump of the bus trace buffer (see bustrace.py), as text with ?format=text"""
+        dump = bustrace.buffer.dump() if bustrace.buffer is not None else None
+        if dump is None:
+            return web.HTTPNotFound()
+        if request.GET.get('format') == 'text':
+            return web.Response(body=bustrace.format_records(dump).encode('utf-8'), content_type='text/plain')
+        return web.Response(body=dump, content_type='application/octet-stream')
 
     def _handle_system(self, command):
         if command["command"] == "shutdown":
@@ -77,11 +194,117 @@ class WebServer:
         
         return web.HTTPBadRequest()
 
-    def _handle_clear(self, command):
-        self.game.field.clear()
-        return web.HTTPOk()
+    @asyncio.coroutine
+    def _handle_batch(self, request):
+        """Applies an ordered list of commands all at once, so no frame shows an intermediate state.
+        Nothing is applied if any of the commands is invalid."""
+        try:
+            commands = yield from request.json()
+        except ValueError:
+            return self._json_response({"error": "invalid JSON"}, status=400)
 
-    def _handle_add_brick(self, command):
+        if self.game is None:
+            return web.HTTPInternalServerError()
+
+        status, body = self._apply_batch(commands)
+        return self._json_response(body, status=status)
+
+    def _apply_batch(self, commands):
+        "Returns the HTTP status and the JSON body"
+        if not isinstance(commands, list):
+            return 400, {"error": "expected a list of commands"}
+
+        self._cancel_effects()
+        operations = []
+        for index, command in enumerate(commands):
+            try:
+                operations.append(self._parse_command(command))
+            except CommandError as ex:
+                return 400, {"error": str(ex), "index": index}
+
+        for operation in operations:
+            operation()
+        return 200, {"applied": len(operations)}
+
+    def _cancel_effects(self):
+        "The first command ends the startup and idle effects"
+        if self.effects is not None:
+            self.effects.cancel()
+            self.effects = None
+
+    def _json_response(self, body, status=200):
+        return web.Response(body=json.dumps(body).encode('utf-8'), status=status, content_type='application/json')
+
+    def _parse_command(self, command):
+        "Validates a command and returns a function applying it to the game"
+        if not isinstance(command, dict):
+            raise CommandError("command is not an object")
+        try:
+            action = command["action"]
+            if action == "clear":
+                return self.game.field.clear
+            if action == "add_brick":
+                brick = self._parse_brick(command)
+                return lambda: self.game.place_brick(brick)
+            if action == "set_cell":
+                x, y = self._parse_int(command["x"], "x"), self._parse_int(command["y"], "y")
+                if not (0 <= x < self.game.width and 0 <= y < self.game.height):
+                    raise CommandError("cell (%d, %d) outside of the field" % (x, y))
+                color = self._parse_color(command["color"]) if command.get("color") is not None else None
+                return lambda: self.game.field.set_cell(x, y, color)
+            if action in self.COMPONENT_ACTIONS:
+                component = self.COMPONENT_ACTIONS[action]
+                components = {component: self._parse_component(command, component)}
+                cells = self._parse_cells(command)
+                return lambda: self.game.field.set_cells(cells, **components)
+            if action == "set_cells":
+                if "color" in command:
+                    components = {name: self._parse_component(command["color"], name) for name in self.COMPONENTS}
+                else:
+                    components = {name: self._parse_component(command, name) for name in self.COMPONENTS if name in command}
+                    if not components:
+                        raise CommandError("set_cells needs a color or at least one of %s" % ', '.join(self.COMPONENTS))
+                cells = self._parse_cells(command)
+                return lambda: self.game.field.set_cells(cells, **components)
+        except (KeyError, TypeError, ValueError) as ex:
+            raise CommandError("invalid %s command: %r" % (command.get("action"), ex))
+        raise CommandError("unknown action: %s" % action)
+
+    def _parse_component(self, values, name):
+        value = float(values[name])
+        if not 0 <= value <= 1:
+            raise CommandError("%s not in interval [0, 1]: %s" % (name, value))
+        return value
+
+    def _parse_cells(self, command):
+        """Cells of the "cells" list of {"x", "y"} objects and the "regions" list of
+        {"x", "y", "width", "height"} rectangles"""
+        if "cells" not in command and "regions" not in command:
+            raise CommandError("no cells or regions given")
+        cells = []
+        for cell in command.get("cells", []):
+            cells.append((self._parse_int(cell["x"], "x"), self._parse_int(cell["y"], "y")))
+        for region in command.get("regions", []):
+            left, top = self._parse_int(region["x"], "x"), self._parse_int(region["y"], "y")
+            width, height = self._parse_int(region["width"], "width"), self._parse_int(region["height"], "height")
+            if not (0 <= left and 0 <= width and left + width <= self.game.width and
+                    0 <= top and 0 <= height and top + height <= self.game.height):
+                raise CommandError("region (%d, %d, %d, %d) outside of the field" % (left, top, width, height))
+            cells.extend((x, y) for x in range(left, left + width) for y in range(top, top + height))
+        for x, y in cells:
+            if not (0 <= x < self.game.width and 0 <= y < self.game.height):
+                raise CommandError("cell (%d, %d) outside of the field" % (x, y))
+        return cells
+
+    def _parse_int(self, value, name):
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or (isinstance(value, float) and not value.is_integer()):
+            raise CommandError("%s is not an integer: %r" % (name, value))
+        return int(value)
+
+    def _parse_color(self, color):
+        return Color(*(self._parse_component(color, name) for name in self.COMPONENTS))
+
+    def _parse_brick(self, command):
         shapeMap = {
                 'T': Shape.T,
                 'O': Shape.O,
@@ -92,17 +315,34 @@ class WebServer:
                 'S': Shape.S,
             }
 
-        self._handle_clear(command)        # TODO: remove
-
         shape = shapeMap.get(command["shape"], None)
         if shape is None:
-            return web.HTTPBadRequest()
+            raise CommandError("unknown shape: %s" % command["shape"])
         
-        color = Color(command["color"]["hue"], command["color"]["saturation"], command["color"]["brightness"])
-        brick = Brick(shape, color, command["origin"]["x"], command["origin"]["y"])
+        color = self._parse_color(command["color"])
+        x = self._parse_int(command["origin"]["x"], "origin.x")
+        y = self._parse_int(command["origin"]["y"], "origin.y")
+        if not (0 <= x < self.game.width and 0 <= y < self.game.height):
+            raise CommandError("origin (%d, %d) outside of the field" % (x, y))
+        rotation = self._parse_int(command["rotation"], "rotation")
+        if rotation < 0:
+            raise CommandError("negative rotation: %d" % rotation)
+        brick = Brick(shape, color, x, y)
         brick.gravity_affected = False
-        for _ in range(command["rotation"]):
+        for _ in range(rotation % 4):
             brick.rotate_cw()
-        
+        return brick
+
+    def _handle_clear(self, command):
+        self.game.field.clear()
+        return web.HTTPOk()
+
+    def _handle_add_brick(self, command):
+        try:
+            brick = self._parse_brick(command)
+        except (CommandError, KeyError, TypeError, ValueError):
+            return web.HTTPBadRequest()
+
+        self._handle_clear(command)        # TODO: remove
         self.game.place_brick(brick)
         return web.HTTPOk()